@@ -2,57 +2,50 @@
 clean_csv.py
 
 Usage:
-  python clean_csv.py stacks_formal_informal_new.csv
+  python clean_csv.py stacks_formal_informal_new.csv [output]
 
 Creates:
-  input_clean.csv
+  input_clean.csv (or output; .csv and .parquet files are supported for
+  input and output, see dataset_io.py in the repository root)
 
 Behavior:
   Removes any row where formal_proof OR augmented_proof is empty 
   (after stripping whitespace).
 """
 
-import csv
+import os
 import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset_io import read_dataset, write_dataset  # shared with the evaluators in the repository root
+
 
 OUTPUT_FILE = "input_clean.csv"
 REQUIRED_COLS = ("formal_proof", "augmented_proof")
 
 
 def clean_csv(input_path: str, output_path: str) -> None:
-    with open(input_path, newline="", encoding="utf-8") as f_in:
-        reader = csv.DictReader(f_in)
-        if not reader.fieldnames:
-            raise ValueError("Input CSV has no header row.")
-
-        missing = [c for c in REQUIRED_COLS if c not in reader.fieldnames]
-        if missing:
-            raise ValueError(f"Missing required columns: {missing}. Found: {reader.fieldnames}")
-
-        with open(output_path, "w", newline="", encoding="utf-8") as f_out:
-            writer = csv.DictWriter(f_out, fieldnames=list(reader.fieldnames))
-            writer.writeheader()
+    df = read_dataset(input_path, encoding="utf-8", keep_default_na=False)
 
-            for row in reader:
-                formal = (row.get("formal_proof") or "").strip()
-                augmented = (row.get("augmented_proof") or "").strip()
+    missing = [c for c in REQUIRED_COLS if c not in df.columns]
+    if missing:
+        raise ValueError(f"Missing required columns: {missing}. Found: {list(df.columns)}")
 
-                # Skip rows where either column is empty
-                if not formal or not augmented:
-                    continue
+    # Skip rows where either column is empty
+    keep = (df["formal_proof"].fillna("").str.strip() != "") & (df["augmented_proof"].fillna("").str.strip() != "")
 
-                writer.writerow(row)
+    write_dataset(df[keep], output_path)
 
 
 def main() -> None:
-    if len(sys.argv) != 2:
-        print("Usage: python clean_csv.py stacks_formal_informal_new.csv")
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python clean_csv.py stacks_formal_informal_new.csv [output]")
         sys.exit(2)
 
     input_path = sys.argv[1]
-    clean_csv(input_path, OUTPUT_FILE)
-    print(f"Wrote cleaned CSV to: {OUTPUT_FILE}")
+    output_path = sys.argv[2] if len(sys.argv) == 3 else OUTPUT_FILE
+    clean_csv(input_path, output_path)
+    print(f"Wrote cleaned CSV to: {output_path}")
 
 
 if __name__ == "__main__":
@@ -1,20 +1,44 @@
-import csv
+import hashlib
 import json
 import os
+import sqlite3
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset_io import read_dataset, write_dataset  # shared with the scripts in the repository root
+from http_utils import RateLimiter
 
 # For Exp I & II the input file is stacks_formal_informal_new.csv 
 # For Exp III the input file is  input_clean.csv
 # For Exp IV the input file is input_InformProof_with_Den.csv
+# Input and output may also be .parquet files (see dataset_io.py in the repository root)
 INPUT_CSV = "input_clean.csv" 
 OUTPUT_CSV = "output3_new.csv"
 
 # Using gpt 5.2: among variants of gpt 5.2., I don't see THINKING available
 MODEL = "gpt-5.2"  
 
-SLEEP_BETWEEN_CALLS_SEC = 0.2
+# Judgments run concurrently; finished rows are appended to CHECKPOINT_JSONL by row id (1-based position
+# in INPUT_CSV) together with the cache key of their prompt, so a restarted run only judges the rows that
+# are missing or whose prompt changed (e.g. after switching SYSTEM_PROMPT and INPUT_CSV to another experiment).
+CHECKPOINT_JSONL = OUTPUT_CSV + ".checkpoint.jsonl"
+MAX_WORKERS = 8  # concurrent requests
+REQUESTS_PER_MINUTE = 120
 MAX_RETRIES = 5
+# Raw responses are cached by (MODEL, SYSTEM_PROMPT, temperature, prompt), so unchanged experiments are
+# replayed without API calls. With LLM_REPLAY_ONLY=1 uncached prompts fail instead of calling the API.
+# Set OPENAI_BASE_URL to point the client at a local stub server.
+CACHE_DB = "llm_cache.sqlite"
+REPLAY_ONLY = os.environ.get("LLM_REPLAY_ONLY") == "1"
+# Batch mode (python gpt_comparison.py --batch) submits all missing rows as one Batch API job.
+BATCH_INPUT_JSONL = OUTPUT_CSV + ".batch_input.jsonl"
+BATCH_STATE_JSON = OUTPUT_CSV + ".batch.json"
+BATCH_POLL_SEC = 60
 TIMEOUT_SEC = 60  # not used by SDK directly in all modes, but kept for clarity
 
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY")) # OPENAI_API_KEY obtained from OpenAI Platform. exported as variable at .zshrc
@@ -144,6 +168,8 @@ of the lemmas that are being used in the proof.
 
 # """
 
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE / 60)
+
 def call_model(prompt: str, temperature: float = 0.0) -> str:
     """
     Tries Responses API first (best for newer models), falls back to Chat Completions.
@@ -153,6 +179,7 @@ def call_model(prompt: str, temperature: float = 0.0) -> str:
     last_err = None
 
     for attempt in range(1, MAX_RETRIES + 1):
+        rate_limiter.acquire()
         try:
             # Preferred: Responses API
             resp = client.responses.create(
@@ -171,6 +198,7 @@ def call_model(prompt: str, temperature: float = 0.0) -> str:
             last_err = e1
             # Fallback: Chat Completions API
             try:
+                rate_limiter.acquire()
                 resp = client.chat.completions.create(
                     model=MODEL,
                     temperature=temperature,
@@ -190,6 +218,42 @@ def call_model(prompt: str, temperature: float = 0.0) -> str:
 
     return f'{{"error":"{str(last_err).replace(chr(34), chr(39))}"}}'
 
+cache_lock = threading.Lock()
+cache_con = None
+
+def cache_key(prompt: str, temperature: float) -> str:
+    system_prompt_hash = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+    return hashlib.sha256(json.dumps([MODEL, system_prompt_hash, temperature, prompt]).encode("utf-8")).hexdigest()
+
+def cache_get(key: str):
+    global cache_con
+    with cache_lock:
+        if cache_con is None:
+            cache_con = sqlite3.connect(CACHE_DB, check_same_thread=False)
+            cache_con.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT)")
+        hit = cache_con.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+    return hit[0] if hit else None
+
+def cache_put(key: str, raw: str) -> None:
+    with cache_lock:
+        with cache_con:
+            cache_con.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, MODEL, raw))
+
+def cached_call_model(prompt: str, temperature: float = 0.0) -> str:
+    """
+    call_model() behind the on-disk response cache. Failed calls are not cached.
+    """
+    key = cache_key(prompt, temperature)
+    hit = cache_get(key)
+    if hit is not None:
+        return hit
+    if REPLAY_ONLY:
+        return '{"error":"response not cached and LLM_REPLAY_ONLY is set"}'
+    raw = call_model(prompt, temperature=temperature)
+    if not raw.startswith('{"error":'):
+        cache_put(key, raw)
+    return raw
+
 def build_prompt(formal_proof: str, augmented_proof: str) -> str: # For EXP I, II, III replace Informal_proof_comment with augmented_proof
     return (
         "Compare the following proofs.\n\n"
@@ -219,49 +283,225 @@ def ensure_json(text: str) -> str:
                 pass
         return json.dumps({"error": "Invalid JSON returned by model", "raw": text}, ensure_ascii=False)
 
-def main():
-    with open(INPUT_CSV, newline="", encoding="utf-8") as f_in, \
-         open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f_out:
+def row_proofs(row: dict) -> tuple:
+    formal = (row.get("formal_proof") or "").strip()
+    augmented = (row.get("augmented_proof") or "").strip() # For EXP I, II, III replace Informal_proof_comment with augmented_proof
+    return formal, augmented
+
+def empty_comparison_json() -> str:
+    return json.dumps({
+        "same_statement": "uncertain",
+        "same_claims": "uncertain",
+        "same_proof_structure": "uncertain",
+        "shorter_due_to_lemmas_or_packages": {
+            "formal_proof": "uncertain",
+            "augmented_proof": "uncertain", # For EXP I, II, III replace Informal_proof_comment with augmented_proof
+            "which_is_shorter": "uncertain",
+            "notes": "Both proofs are empty."
+        },
+        "brief_justification": "No content provided."
+    }, ensure_ascii=False)
+
+def row_key(row: dict) -> str:
+    """
+    Cache key of the prompt judging the row; a checkpointed judgment is reused only under the same key.
+    """
+    return cache_key(build_prompt(*row_proofs(row)), 0.0)
 
-        reader = csv.DictReader(f_in)
-        if not reader.fieldnames:
-            raise ValueError("CSV appears to have no header row.")
+def judge_row(row: dict) -> tuple:
+    """
+    Returns (comparison_json, done). done is False if the API call failed, so that the row is retried
+    on the next run instead of being checkpointed.
+    """
+    formal, augmented = row_proofs(row)
+    if not formal and not augmented:
+        return empty_comparison_json(), True
 
-        required = {"formal_proof", "augmented_proof"} # For EXP I, II, III replace Informal_proof_comment with augmented_proof
-        missing = required - set(reader.fieldnames)
-        if missing:
-            raise ValueError(f"CSV must contain columns: {sorted(required)}. Missing: {sorted(missing)}")
+    prompt = build_prompt(formal, augmented)
+    raw = cached_call_model(prompt, temperature=0.0)
+    return ensure_json(raw), not raw.startswith('{"error":')
 
-        fieldnames = list(reader.fieldnames) + ["comparison_json"]
-        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-        writer.writeheader()
+def load_checkpoint(path: str, keys: dict) -> dict:
+    """
+    Reads row_id -> comparison_json from the append-only checkpoint, keeping only the rows whose stored
+    key equals keys[row_id]; a truncated last line is ignored.
+    """
+    done = {}
+    stale = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f_ckpt:
+        for line in f_ckpt:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("key") == keys.get(record["row_id"]):
+                done[record["row_id"]] = record["comparison_json"]
+            else:
+                stale.add(record["row_id"])
+    stale -= set(done)
+    if stale:
+        print(f"{len(stale)} checkpointed rows were judged with another prompt and are judged again")
+    return done
+
+def read_input() -> tuple:
+    df = read_dataset(INPUT_CSV, encoding="utf-8", keep_default_na=False)
+    fieldnames, rows = list(df.columns), df.to_dict("records")
+
+    required = {"formal_proof", "augmented_proof"} # For EXP I, II, III replace Informal_proof_comment with augmented_proof
+    missing = required - set(fieldnames)
+    if missing:
+        raise ValueError(f"CSV must contain columns: {sorted(required)}. Missing: {sorted(missing)}")
+
+    return fieldnames + ["comparison_json"], rows
+
+def write_checkpoint(f_ckpt, idx: int, key: str, comparison_json: str) -> None:
+    f_ckpt.write(json.dumps({"row_id": idx, "key": key, "comparison_json": comparison_json},
+                            ensure_ascii=False) + "\n")
+    f_ckpt.flush()
+
+def write_output(fieldnames: list, rows: list, done: dict, failed: dict) -> None:
+    for idx, row in enumerate(rows, start=1):
+        row["comparison_json"] = done.get(idx, failed.get(idx))
+    write_dataset(pd.DataFrame(rows, columns=fieldnames), OUTPUT_CSV)
+    if failed:
+        print(f"{len(failed)} rows failed and will be retried on the next run: {sorted(failed)}")
 
-        for idx, row in enumerate(reader, start=1):
-            formal = (row.get("formal_proof") or "").strip()
-            augmented = (row.get("augmented_proof") or "").strip() # For EXP I, II, III replace Informal_proof_comment with augmented_proof
+def main():
+    fieldnames, rows = read_input()
+    keys = {idx: row_key(row) for idx, row in enumerate(rows, start=1)}
+    done = load_checkpoint(CHECKPOINT_JSONL, keys)
+    todo = [(idx, row) for idx, row in enumerate(rows, start=1) if idx not in done]
+    print(f"{len(rows) - len(todo)} of {len(rows)} rows already judged, {len(todo)} to go")
+
+    failed = {}
+    with open(CHECKPOINT_JSONL, "a", encoding="utf-8") as f_ckpt, \
+         ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {pool.submit(judge_row, row): idx for idx, row in todo}
+        for future in as_completed(futures):
+            idx = futures[future]
+            comparison_json, ok = future.result()
+            if not ok:
+                failed[idx] = comparison_json
+                continue
+            done[idx] = comparison_json
+            write_checkpoint(f_ckpt, idx, keys[idx], comparison_json)
+
+    write_output(fieldnames, rows, done, failed)
+
+def batch_request_line(idx: int, prompt: str, temperature: float = 0.0) -> str:
+    return json.dumps({
+        "custom_id": f"row-{idx}",
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": {
+            "model": MODEL,
+            "input": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": temperature,
+        },
+    }, ensure_ascii=False)
+
+def batch_output_text(body: dict) -> str:
+    """
+    Concatenates the output_text parts of a Responses API body, as resp.output_text does in the SDK.
+    """
+    texts = [part.get("text", "")
+             for item in body.get("output", []) if item.get("type") == "message"
+             for part in item.get("content", []) if part.get("type") == "output_text"]
+    return "".join(texts).strip()
 
+def main_batch():
+    """
+    Judges all rows missing from the checkpoint with one Batch API job: cached prompts are answered
+    locally, the rest are uploaded as JSONL, the job is polled until it finishes and its results are
+    merged into the checkpoint, the cache and OUTPUT_CSV by row id. The job id is kept in BATCH_STATE_JSON,
+    so an interrupted run resumes polling instead of submitting the job again.
+    """
+    fieldnames, rows = read_input()
+    keys = {idx: row_key(row) for idx, row in enumerate(rows, start=1)}
+    done = load_checkpoint(CHECKPOINT_JSONL, keys)
+    failed = {}
+    prompts = {}
+    with open(CHECKPOINT_JSONL, "a", encoding="utf-8") as f_ckpt:
+        for idx, row in enumerate(rows, start=1):
+            if idx in done:
+                continue
+            formal, augmented = row_proofs(row)
             if not formal and not augmented:
-                row["comparison_json"] = json.dumps({
-                    "same_statement": "uncertain",
-                    "same_claims": "uncertain",
-                    "same_proof_structure": "uncertain",
-                    "shorter_due_to_lemmas_or_packages": {
-                        "formal_proof": "uncertain",
-                        "augmented_proof": "uncertain", # For EXP I, II, III replace Informal_proof_comment with augmented_proof
-                        "which_is_shorter": "uncertain",
-                        "notes": "Both proofs are empty."
-                    },
-                    "brief_justification": "No content provided."
-                }, ensure_ascii=False)
-                writer.writerow(row)
+                done[idx] = empty_comparison_json()
+                write_checkpoint(f_ckpt, idx, keys[idx], done[idx])
                 continue
-
             prompt = build_prompt(formal, augmented)
-            raw = call_model(prompt, temperature=0.0)
-            row["comparison_json"] = ensure_json(raw)
-
-            writer.writerow(row)
-            time.sleep(SLEEP_BETWEEN_CALLS_SEC)
+            hit = cache_get(keys[idx])
+            if hit is not None:
+                done[idx] = ensure_json(hit)
+                write_checkpoint(f_ckpt, idx, keys[idx], done[idx])
+            else:
+                prompts[idx] = prompt
+    print(f"{len(rows) - len(prompts)} of {len(rows)} rows already judged or cached, {len(prompts)} to go")
+
+    if prompts and not REPLAY_ONLY:
+        if os.path.exists(BATCH_STATE_JSON):
+            with open(BATCH_STATE_JSON, encoding="utf-8") as f_state:
+                state = json.load(f_state)
+        else:
+            with open(BATCH_INPUT_JSONL, "w", encoding="utf-8") as f_batch:
+                for idx, prompt in prompts.items():
+                    f_batch.write(batch_request_line(idx, prompt) + "\n")
+            with open(BATCH_INPUT_JSONL, "rb") as f_batch:
+                input_file = client.files.create(file=f_batch, purpose="batch")
+            batch_id = client.batches.create(input_file_id=input_file.id, endpoint="/v1/responses",
+                                             completion_window="24h").id
+            state = {"batch_id": batch_id, "keys": {str(idx): keys[idx] for idx in prompts}}
+            with open(BATCH_STATE_JSON, "w", encoding="utf-8") as f_state:
+                json.dump(state, f_state)
+        # the keys the job was submitted under: a job resumed after the prompts changed still fills the
+        # cache correctly, but only rows whose key is unchanged are taken from it
+        batch_id = state["batch_id"]
+        batch_keys = {int(idx): key for idx, key in state.get("keys", {}).items()}
+        print(f"Waiting for batch {batch_id}")
+
+        batch = client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(BATCH_POLL_SEC)
+            batch = client.batches.retrieve(batch_id)
+        print(f"Batch {batch_id} {batch.status}")
+
+        with open(CHECKPOINT_JSONL, "a", encoding="utf-8") as f_ckpt:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                for line in client.files.content(file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    idx = int(result["custom_id"][len("row-"):])
+                    response = result.get("response") or {}
+                    raw = batch_output_text(response.get("body") or {}) if response.get("status_code") == 200 else ""
+                    batch_key = batch_keys.get(idx, keys.get(idx))
+                    if raw and batch_key:
+                        cache_put(batch_key, raw)
+                    if idx not in prompts or batch_key != keys[idx]:
+                        continue
+                    if not raw:
+                        error = result.get("error") or (response.get("body") or {}).get("error")
+                        failed[idx] = json.dumps({"error": str(error)}, ensure_ascii=False)
+                        continue
+                    done[idx] = ensure_json(raw)
+                    write_checkpoint(f_ckpt, idx, keys[idx], done[idx])
+        os.remove(BATCH_STATE_JSON)
+
+    for idx in prompts:
+        if idx not in done and idx not in failed:
+            failed[idx] = '{"error":"no batch result"}'
+    write_output(fieldnames, rows, done, failed)
 
 if __name__ == "__main__":
-    main()
+    if "--batch" in sys.argv[1:]:
+        main_batch()
+    else:
+        main()
@@ -1,5 +1,10 @@
-import csv
+import os
+import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset_io import read_dataset, write_dataset  # shared with the evaluators in the repository root
+
+# .csv or .parquet (see dataset_io.py in the repository root)
 INPUT_CSV = "input_clean.csv"
 OUTPUT_CSV = "input_InformProof_with_Den.csv"
 
@@ -9,43 +14,29 @@ FIXED_SENTENCE_PREFIX = (
 )
 
 def main():
-    with open(INPUT_CSV, newline="", encoding="utf-8") as f_in:
-        reader = csv.DictReader(f_in)
-        if not reader.fieldnames:
-            raise ValueError("input_clean.csv has no header row.")
-
-        required_cols = {"augmented_proof", "Den"}
-        missing = required_cols - set(reader.fieldnames)
-        if missing:
-            raise ValueError(f"Missing required columns: {sorted(missing)}")
-
-        out_fieldnames = list(reader.fieldnames)
-        if "Informal_proof_comment" not in out_fieldnames:
-            out_fieldnames.append("Informal_proof_comment")
-
-        rows = []
-        for row in reader:
-            augmented = (row.get("augmented_proof") or "").strip()
-            den = (row.get("Den") or "").strip()
-
-            if den == "":
-                # If Den is empty, just copy augmented_proof
-                row["Informal_proof_comment"] = augmented
-            else:
-                # Otherwise: augmented_proof + sentence + Den
-                if augmented:
-                    row["Informal_proof_comment"] = (
-                        augmented + "\n\n" + FIXED_SENTENCE_PREFIX + den
-                    )
-                else:
-                    row["Informal_proof_comment"] = FIXED_SENTENCE_PREFIX + den
-
-            rows.append(row)
-
-    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f_out:
-        writer = csv.DictWriter(f_out, fieldnames=out_fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+    df = read_dataset(INPUT_CSV, encoding="utf-8", keep_default_na=False)
+
+    required_cols = {"augmented_proof", "Den"}
+    missing = required_cols - set(df.columns)
+    if missing:
+        raise ValueError(f"Missing required columns: {sorted(missing)}")
+
+    def informal_proof_comment(augmented, den):
+        augmented = (augmented or "").strip()
+        den = (den or "").strip()
+
+        if den == "":
+            # If Den is empty, just copy augmented_proof
+            return augmented
+        # Otherwise: augmented_proof + sentence + Den
+        if augmented:
+            return augmented + "\n\n" + FIXED_SENTENCE_PREFIX + den
+        return FIXED_SENTENCE_PREFIX + den
+
+    df["Informal_proof_comment"] = [informal_proof_comment(augmented, den)
+                                    for augmented, den in zip(df["augmented_proof"], df["Den"])]
+
+    write_dataset(df, OUTPUT_CSV)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,407 @@
+import argparse
+import contextlib
+import csv
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmark harness for the evaluation pipeline of mathlib_refs.py that needs neither mathlib4, network access
+# nor leansearch.net. A synthetic workspace is generated first: a mathlib-like tree of .lean files (module
+# docstrings with references, namespaces, docstrings, @[stacks ...] blocks), references_with_zbl.bib, a
+# stacks_project.csv whose statements cite each other, and wikitext served by a local MediaWiki API stand-in.
+# mathlib_refs is then imported with that workspace as working directory, and every stage is timed on it:
+# scanning, bib matching, stacks html conversion, augmentation, wikipedia fetch/parse, retrieval through the
+# cache with a canned retriever, and scoring.
+#
+#   python benchmark.py                      # times the current tree and compares with the last other commit
+#   python benchmark.py --tree ../checkout   # times mathlib_refs.py of another checkout (e.g. a git worktree)
+#   python benchmark.py --baseline 1c2df3d   # compares with the latest run of that commit instead
+#
+# Every run is appended to reports/benchmark_history.jsonl with the commit of the timed tree, so regressions
+# are tracked across commits; stages slower than --threshold times the baseline are reported and make the
+# run exit with status 1. Stages whose functions do not exist in the timed tree are skipped, stages that
+# fail there are reported and left out.
+
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports', 'benchmark_history.jsonl')
+AREAS = ['Algebra', 'Analysis', 'CategoryTheory', 'NumberTheory', 'RingTheory', 'Topology', 'AlgebraicGeometry']
+WORDS = ['ring', 'module', 'ideal', 'field', 'group', 'compact', 'open', 'prime', 'finite', 'flat', 'scheme',
+         'sheaf', 'morphism', 'integral', 'local', 'noetherian', 'continuous', 'measure', 'polynomial', 'basis']
+KINDS = ['theorem', 'lemma', 'def', 'instance']
+
+
+def _words(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def _camel(rng, n):
+    return "".join(rng.choice(WORDS).capitalize() for _ in range(n))
+
+
+def make_workspace(root, n_files=1000, decls_per_file=20, n_tags=3000, n_titles=500, n_queries=2000, seed=0):
+    # writes the synthetic workspace to root and returns the fixtures the stages need
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+
+    # references_with_zbl.bib: every third entry is a book, most have a zbl_new identifier
+    bib_ids = [f'{_camel(rng, 1)}{1950 + i % 70}{chr(97 + i % 26)}{i}' for i in range(max(n_files // 2, 1))]
+    with open(os.path.join(root, 'references_with_zbl.bib'), 'w', encoding='utf-8') as fh:
+        for i, bib_id in enumerate(bib_ids):
+            zbl = f'  zbl_new = {{{1000 + i}.{10000 + i}}},\n' if i % 5 else ''
+            fh.write(f'@{"book" if i % 3 == 0 else "article"}{{{bib_id},\n  title = {{{_words(rng, 4)}}},\n'
+                     f'{zbl}  year = {{{1950 + i % 70}}}\n}}\n\n')
+
+    # stacks tags with references, statements citing earlier references, and proofs
+    tags = [f'{i:04X}' for i in range(n_tags)]
+    references = [f'{1 + i // 400}.{1 + (i // 20) % 20}.{1 + i % 20}' for i in range(n_tags)]
+    rows = []
+    for i, (tag, reference) in enumerate(zip(tags, references)):
+        cited = [references[rng.randrange(i)] for _ in range(rng.randint(0, 3))] if i else []
+        statement = f"Lemma {reference}. Let $R$ be a {_words(rng, 3)} &amp; $M$ a {_words(rng, 2)}."
+        proof = " ".join(f"By Lemma {ref} the {_words(rng, 3)}." for ref in cited) or _words(rng, 12)
+        html = (f'<p>{statement}</p><p><strong>Proof.</strong> {proof}</p><!-- {tag} -->'
+                f'<p>This proves the <a href="/tag/{tag}">{_words(rng, 2)}</a>.</p>')
+        rows.append([tag, _words(rng, 2), reference, 'lemma', 1 + i % 4, str(['0ELQ']), str(html.encode('utf-8'))])
+    with open(os.path.join(root, 'stacks_project.csv'), 'w', encoding='utf-8', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['tag', 'name', 'reference', 'type', 'depth', 'parents', 'content'])
+        writer.writerows(rows)
+
+    # the mathlib-like tree; declarations are collected as the gold items of the retrieval queries
+    titles = [f'{_camel(rng, 2)}_theorem_{i}' for i in range(n_titles)]
+    declarations = []
+    for f in range(n_files):
+        module = ['Mathlib', AREAS[f % len(AREAS)], _camel(rng, 1), f'{_camel(rng, 2)}{f}']
+        path = os.path.join(root, 'mathlib4', *module[:-1], module[-1] + '.lean')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        references_section = "".join(f"* [{rng.choice(bib_ids)}]\n" for _ in range(rng.randint(0, 3)))
+        references_section += "".join(f"* <https://en.wikipedia.org/wiki/{rng.choice(titles)}>\n"
+                                      for _ in range(rng.randint(0, 2)))
+        lines = ["/-\nCopyright (c) 2024. All rights reserved.\n-/\n", "import Mathlib.Init\n\n",
+                 f"/-!\n# {_words(rng, 3)}\n\n{_words(rng, 20)}\n\n## References\n\n{references_section}-/\n\n",
+                 f"namespace {module[-2]}\n\n"]
+        for d in range(decls_per_file):
+            name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{d}"
+            signature = f"{rng.choice(KINDS)} {name} (x : {module[-1]}) (h : {_words(rng, 3)}) : {_words(rng, 4)}"
+            body = ":= by\n  simp [foo]\n  exact h\n"
+            doc = _words(rng, 10)
+            if rng.random() < 0.05:
+                lines.append(f'@[stacks {rng.choice(tags)} "{_words(rng, 2)}"]\n')
+            lines.append(f"/-- {doc} -/\n{signature} {body}\n")
+            declarations.append({'module_name': module, 'code': f"{signature} {body}", 'doc': doc,
+                                 'signature': signature, 'name': [module[-2], name]})
+        lines.append(f"end {module[-2]}\n")
+        with open(path, 'w', encoding='utf-8') as fh:
+            fh.write("".join(lines))
+
+    # retrieval queries: a few gold declarations per query, phrased by their docstrings
+    queries = []
+    for q in range(n_queries):
+        gold = rng.sample(declarations, rng.randint(1, 3))
+        queries.append({'texts': f"{q} " + " ".join(item['doc'] for item in gold),
+                        'module_name': [item['module_name'] for item in gold],
+                        'code': [item['code'] for item in gold],
+                        'formal_statement': [item['code'].split(':=')[0] for item in gold]})
+    return {'root': root, 'declarations': declarations, 'queries': queries, 'titles': titles, 'seed': seed}
+
+
+def canned_responses(fixtures, num_results=10):
+    # recorded-style responses: the gold declarations at random ranks among random other declarations
+    rng = random.Random(fixtures['seed'] + 1)
+    declarations = fixtures['declarations']
+    by_code = {item['code']: item for item in declarations}
+    responses = {}
+    for query in fixtures['queries']:
+        items = rng.sample(declarations, num_results)
+        for code in query['code']:
+            if rng.random() < 0.6:
+                items[rng.randrange(num_results)] = by_code[code]
+        responses[query['texts']] = [{'result': {'module_name': item['module_name'], 'signature': item['signature'],
+                                                 'name': item['name']}} for item in items]
+    return responses
+
+
+def make_canned_search(responses):
+    def canned_search(df, column, new_col_name='canned_search', num_results=10):
+        df[new_col_name] = [responses[text][:num_results] for text in df[column].to_list()]
+        return df
+    return canned_search
+
+
+def wikitext(title):
+    return (f"'''{title}''' is a theorem.\n== History ==\nFirst proved long ago.\n"
+            f"== Statement ==\nLet ''G'' be a [[group]]. Then {title.replace('_', ' ')} holds for all "
+            f"{{{{math|''x'' ∈ ''G''}}}}.<ref>Book</ref>\n== Proof ==\nTrivial.\n")
+
+
+class _WikiHandler(BaseHTTPRequestHandler):
+    # answers the two query forms used by get_theorems_bulk (rvprop=ids and rvprop=ids|content)
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        query = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        with_content = 'content' in query['rvprop'][0]
+        pages, normalized = {}, []
+        for i, title in enumerate(query['titles'][0].split('|')):
+            page_title = title.replace('_', ' ')
+            if page_title != title:
+                normalized.append({'from': title, 'to': page_title})
+            revision = {'revid': 1}
+            if with_content:
+                revision['*'] = wikitext(page_title)
+            pages[str(1000 + i)] = {'title': page_title, 'revisions': [revision]}
+        body = json.dumps({'query': {'normalized': normalized, 'pages': pages}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_wiki():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _WikiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/w/api.php'
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def make_stages(m, fixtures):
+    # returns list of (name, setup, run); setup is not timed, a stage is skipped if run needs missing functions
+    import pandas as pd
+    root = fixtures['root']
+    stacks_path = os.path.join(root, 'stacks_project.csv')
+    cache_path = os.path.join(root, 'cache', 'benchmark_retrieval.sqlite')
+    query_df = pd.DataFrame(fixtures['queries'])
+    m.canned_search = make_canned_search(canned_responses(fixtures))
+    state = {}
+
+    def clear_scans():
+        getattr(m, '_MATHLIB_SCANS', {}).clear()
+        getattr(m, '_MATHLIB_DECLARATIONS', {}).clear()
+
+    def cold_scan():
+        clear_scans()
+        _remove(getattr(m, 'SCAN_INDEX_PATH', ''))
+
+    def stacks_texts():
+        if hasattr(m, 'load_stacks_texts'):
+            return m.load_stacks_texts(stacks_path)
+        from bs4 import BeautifulSoup
+        df = pd.read_csv(stacks_path, encoding='utf-8')
+        df['content'] = df['content'].apply(lambda x: BeautifulSoup(x, features="lxml").text[2:-1])
+        df['statement'] = df.content.apply(lambda t: t[:t.index('Proof.')].strip() if 'Proof.' in t else t.strip())
+        df['proof'] = df.content.apply(lambda t: t[t.index('Proof.'):].strip() if 'Proof.' in t else "")
+        return df
+
+    def prepare_augmentation():
+        state['stacks'] = stacks_texts()
+
+    def augmentation():
+        df = state['stacks']
+        statements = m.reference_statements(df) if hasattr(m, 'reference_statements') else df
+        if hasattr(m, 'expand_statements'):
+            statements = m.expand_statements(statements, m.AUGMENT_DEPTH - 1, m.AUGMENT_MAX_TOKENS)
+        return [m.augment_informal_proof(proof, statements) for proof in df['proof'].to_list()]
+
+    def cold_wiki():
+        _remove(getattr(m, 'WIKI_STORE_PATH', ''))
+
+    def retrieval():
+        return m.cached_retrieval(m.canned_search, query_df.copy(), 'texts', 'canned_search', 'canned_search',
+                                  num_results=10, cache_path=cache_path)
+
+    def prepare_scoring():
+        state['retrieved'] = m.canned_search(query_df.copy(), 'texts')
+
+    def scoring():
+        df = state['retrieved']
+        if not hasattr(m, 'hit_matrix'):
+            return [m.recalls(row['canned_search'], row, condition, n) for _, row in df.iterrows()
+                    for condition in ('module', 'code') for n in (1, 5, 10)]
+        n_gold = df['module_name'].map(len).to_numpy()
+        for condition in ('module', 'code'):
+            hits = m.hit_matrix(df, 'canned_search', condition)
+            m.recalls_at(hits, n_gold)
+            m.per_query_metrics(hits, n_gold)
+
+    def cold_bm25():
+        getattr(m, '_LOCAL_INDEXES', {}).clear()
+        _remove(*[getattr(m, 'BM25_INDEX_PATH', '') + suffix for suffix in ('.npz', '.json')])
+
+    def evaluate():
+        m.df_evaluate(query_df.copy(), 'texts', avail_columns=['module_name', 'code'], retriever='canned_search')
+
+    def needs(*names):
+        return all(hasattr(m, name) for name in names)
+
+    stages = [
+        ('scan_cold', cold_scan, lambda: m.extract_references(), needs('extract_references')),
+        ('scan_warm', clear_scans, lambda: m.extract_references(), needs('extract_references', 'SCAN_INDEX_PATH')),
+        ('bib_matching', None, lambda: (m.match_bibrefs_to_bib_file(), m.match_bibrefs_to_bib_file(books_ok=True)),
+         needs('match_bibrefs_to_bib_file')),
+        ('stacks_refs', None, lambda: m.extract_stacks_attribute_refs(), needs('extract_stacks_attribute_refs')),
+        ('stacks_html_cold', lambda: _remove(os.path.splitext(stacks_path)[0] + '_text.parquet'), stacks_texts, True),
+        ('stacks_html_warm', None, stacks_texts, needs('load_stacks_texts')),
+        ('augmentation', prepare_augmentation, augmentation, needs('augment_informal_proof')),
+        ('wikipedia_cold', cold_wiki, lambda: m.get_theorems_bulk(fixtures['titles']), needs('get_theorems_bulk')),
+        ('wikipedia_warm', None, lambda: m.get_theorems_bulk(fixtures['titles']), needs('WIKI_STORE_PATH')),
+        ('retrieval_cold', lambda: _remove(cache_path), retrieval, needs('cached_retrieval')),
+        ('retrieval_warm', None, retrieval, needs('cached_retrieval')),
+        ('scoring', prepare_scoring, scoring, needs('recalls')),
+        ('bm25_build', cold_bm25, lambda: m.load_bm25_index(), needs('load_bm25_index')),
+        ('bm25_search', None, lambda: m.bm25_search(query_df.copy(), 'texts'), needs('bm25_search')),
+        ('df_evaluate', None, evaluate, needs('df_evaluate')),
+    ]
+    return [(name, setup, run) for name, setup, run, available in stages if available]
+
+
+def run_stages(stages, repeat=3, only=None):
+    # returns dict stage -> {'min':..., 'median':..., 'runs':[...]} in seconds; output of the stages is swallowed
+    timings = {}
+    for name, setup, run in stages:
+        if only and name not in only:
+            continue
+        runs = []
+        try:
+            for _ in range(repeat):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    if setup:
+                        setup()
+                    start = time.perf_counter()
+                    run()
+                    runs.append(time.perf_counter() - start)
+        except Exception as e:
+            # e.g. an older tree whose functions have a different contract; the stage is left out of the record
+            print(f"{name:<18}    failed: {e!r}")
+            continue
+        timings[name] = {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+        print(f"{name:<18} {timings[name]['median']:9.3f}s (min {timings[name]['min']:.3f}s)")
+    return timings
+
+
+def git_commit(tree):
+    try:
+        commit = subprocess.run(['git', '-C', tree, 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', '-C', tree, 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, dirty
+
+
+def load_history(path=HISTORY_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def find_baseline(history, record, baseline=None):
+    # latest run with the same workload, of the given commit (prefix) or else of any other commit
+    candidates = [run for run in history if run['params'] == record['params']]
+    if baseline:
+        candidates = [run for run in candidates if (run['commit'] or '').startswith(baseline)]
+    else:
+        candidates = [run for run in candidates if run['commit'] != record['commit'] or run['dirty'] != record['dirty']]
+    return candidates[-1] if candidates else None
+
+
+def compare(record, baseline, threshold=1.25, min_delta=0.01):
+    # prints stage timings against the baseline run; returns the names of stages slower than threshold times it
+    # (and by more than min_delta seconds, so that noise on very short stages is not reported)
+    print(f"\nbaseline {(baseline['commit'] or 'unknown')[:10]}{' (dirty)' if baseline['dirty'] else ''} "
+          f"from {baseline['timestamp']}")
+    regressions = []
+    for name, timing in record['timings'].items():
+        if name not in baseline['timings']:
+            print(f"{name:<18} {timing['median']:9.3f}s       new")
+            continue
+        ratio = timing['median'] / max(baseline['timings'][name]['median'], 1e-9)
+        flag = ''
+        if ratio > threshold and timing['median'] - baseline['timings'][name]['median'] > min_delta:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<18} {timing['median']:9.3f}s vs {baseline['timings'][name]['median']:9.3f}s  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the mathlib_refs.py evaluation stages on synthetic data")
+    parser.add_argument("--tree", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="checkout whose mathlib_refs.py is timed (default: this one)")
+    parser.add_argument("--files", type=int, default=1000, help="synthetic .lean files")
+    parser.add_argument("--decls", type=int, default=20, help="declarations per file")
+    parser.add_argument("--tags", type=int, default=3000, help="synthetic stacks tags")
+    parser.add_argument("--titles", type=int, default=500, help="synthetic wikipedia titles")
+    parser.add_argument("--queries", type=int, default=2000, help="retrieval queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage")
+    parser.add_argument("--stages", nargs='*', help="only run these stages")
+    parser.add_argument("--baseline", help="commit (prefix) to compare with, default: latest run of another commit")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression")
+    parser.add_argument("--min-delta", type=float, default=0.01, help="slowdowns below this many seconds are ignored")
+    parser.add_argument("--workdir", help="keep the synthetic workspace in this directory")
+    parser.add_argument("--no-record", action="store_true", help="do not append this run to the history")
+    args = parser.parse_args()
+
+    tree = os.path.abspath(args.tree)
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='mathlib_refs_bench_')
+    params = {'files': args.files, 'decls': args.decls, 'tags': args.tags, 'titles': args.titles,
+              'queries': args.queries, 'seed': args.seed}
+    try:
+        start = time.perf_counter()
+        fixtures = make_workspace(workdir, args.files, args.decls, args.tags, args.titles, args.queries, args.seed)
+        print(f"workspace {workdir} generated in {time.perf_counter() - start:.1f}s")
+
+        # mathlib_refs takes its paths from the working directory at import time
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        sys.path.insert(0, tree)
+        m = importlib.import_module('mathlib_refs')
+        server, m.WIKI_API_URL = serve_wiki()
+        try:
+            timings = run_stages(make_stages(m, fixtures), args.repeat, args.stages)
+        finally:
+            server.shutdown()
+            os.chdir(cwd)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit, dirty = git_commit(tree)
+    record = {'commit': commit, 'dirty': dirty, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'params': params, 'timings': timings}
+    baseline = find_baseline(load_history(), record, args.baseline)
+    regressions = compare(record, baseline, args.threshold, args.min_delta) if baseline else []
+    if not args.no_record:
+        os.makedirs(os.path.dirname(HISTORY_PATH), exist_ok=True)
+        with open(HISTORY_PATH, 'a', encoding='utf-8') as fh:
+            fh.write(json.dumps(record) + '\n')
+    if regressions:
+        print(f"\n{len(regressions)} stages slower than x{args.threshold}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
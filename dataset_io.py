@@ -0,0 +1,95 @@
+import ast
+import hashlib
+import json
+import os
+import re
+import sys
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Intermediate datasets (stacks_project, leandocs, the stacks formal/informal tables of the LLM experiments)
+# are read and written as CSV or Parquet, chosen by file extension. Parquet keeps list columns such as
+# module_name and parents typed (list<string>) instead of stringified Python, and is read through a memory map.
+# `python -m dataset_io stacks_project.csv` converts an existing CSV into stacks_project.parquet.
+# Derived datasets are cached as Parquet files carrying a fingerprint of their inputs in the schema metadata
+# (write_cached), and reused as long as the fingerprint matches (read_cached).
+
+LIST_COLUMNS = ('parents', 'module_name')  # list columns stored as stringified Python in the CSVs
+
+
+def parquet_path(path):
+    return os.path.splitext(path)[0] + '.parquet'
+
+
+def resolve_dataset(path):
+    # the Parquet version of path if it exists and is not older than path (which may have been rewritten
+    # since the conversion, e.g. leandocs.csv by zbmath.py), path itself otherwise
+    candidate = parquet_path(path)
+    if not os.path.exists(candidate):
+        return path
+    if os.path.exists(path) and os.path.getmtime(path) > os.path.getmtime(candidate):
+        return path
+    return candidate
+
+
+def read_dataset(path, columns=None, list_columns=LIST_COLUMNS, **csv_kwargs):
+    # csv_kwargs are passed to pd.read_csv and ignored for Parquet files
+    if path.endswith('.parquet'):
+        table = pq.read_table(path, columns=columns, memory_map=True)
+        df = table.to_pandas()
+        # list columns come back as python lists (not numpy arrays), as they are built by the evaluators
+        for name, field in zip(table.column_names, table.schema):
+            if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+                df[name] = table.column(name).to_pylist()
+        return df
+    df = pd.read_csv(path, usecols=columns, **csv_kwargs)
+    # the unnamed index column of CSVs written by DataFrame.to_csv keeps its empty header, so that a
+    # CSV read and written again (or converted to Parquet and back) has the same header
+    unnamed = [column for column in df.columns if re.fullmatch(r'Unnamed: \d+', column)]
+    if len(unnamed) == 1:
+        df = df.rename(columns={unnamed[0]: ''})
+    for column in list_columns:
+        if column in df.columns:
+            df[column] = df[column].map(lambda x: ast.literal_eval(x) if isinstance(x, str) and x.startswith('[')
+                                        else x)
+    return df
+
+
+def write_dataset(df, path, index=False):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=index)
+    else:
+        df.to_csv(path, index=index)
+
+
+def content_fingerprint(path, *keys):
+    # sha1 of the json serializable keys (versions, parameters) and the content of the file at path
+    sha1 = hashlib.sha1(json.dumps(keys).encode('utf-8'))
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_cached(path, fingerprint):
+    # the dataset cached at path if it was written with the same fingerprint, None otherwise
+    if os.path.exists(path) and (pq.read_schema(path).metadata or {}).get(b'fingerprint') == fingerprint.encode():
+        return read_dataset(path)
+    return None
+
+
+def write_cached(df, path, fingerprint):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table.replace_schema_metadata(dict(table.schema.metadata, fingerprint=fingerprint)), path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python -m dataset_io input.csv [output.parquet]")
+        sys.exit(2)
+    output_path = sys.argv[2] if len(sys.argv) == 3 else parquet_path(sys.argv[1])
+    write_dataset(read_dataset(sys.argv[1], encoding='utf-8'), output_path)
+    print(f"Wrote {output_path}")
@@ -0,0 +1,166 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+import instrumentation
+
+# Shared helpers for the scripts talking to leansearch.net, the stacks project, wikipedia and zbmath:
+# pooled keep-alive sessions, a thread-safe rate limiter, retries with exponential backoff and resumable
+# downloads into append-only JSONL files.
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    # token bucket allowing `rate` acquisitions per second with bursts of up to `burst`
+    # rate=None disables limiting
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size=10, headers=None):
+    # one keep-alive connection per worker thread
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def request_with_retry(session, method, url, retries=5, backoff=1.0, limiter=None, **kwargs):
+    # retries connection errors, timeouts, 429 and 5xx responses with exponential backoff (honouring
+    # Retry-After); other 4xx responses raise immediately, the last error is raised once retries are used up
+    kwargs.setdefault('timeout', 60)
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        retry_after = None
+        instrumentation.count('http_requests')
+        try:
+            response = session.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS:
+                response.raise_for_status()
+                return response
+            error = requests.HTTPError(f"{response.status_code} Error for url: {url}", response=response)
+            retry_after = response.headers.get('Retry-After')
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt == retries:
+            instrumentation.count('http_failures')
+            raise error
+        instrumentation.count('http_retries')
+        if retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+        time.sleep(delay)
+
+
+class HttpMetadataStore:
+    # url -> (ETag, Last-Modified) of the last full response, kept in sqlite so that later runs can send
+    # conditional requests and skip unchanged resources (304 Not Modified)
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute('CREATE TABLE IF NOT EXISTS http_meta (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)')
+        self.lock = threading.Lock()
+
+    def conditional_headers(self, url):
+        with self.lock:
+            row = self.con.execute('SELECT etag, last_modified FROM http_meta WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers['If-None-Match'] = row[0]
+        if row and row[1]:
+            headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def update(self, url, response):
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self.lock, self.con:
+                self.con.execute('INSERT OR REPLACE INTO http_meta VALUES (?, ?, ?)', (url, etag, last_modified))
+
+    def close(self):
+        self.con.close()
+
+
+def conditional_get(session, url, store, **kwargs):
+    # GET with If-None-Match/If-Modified-Since from store; returns None if the resource is unchanged
+    headers = dict(kwargs.pop('headers', None) or {}, **store.conditional_headers(url))
+    response = request_with_retry(session, 'GET', url, headers=headers, **kwargs)
+    if response.status_code == 304:
+        instrumentation.count('http_not_modified')
+        return None
+    store.update(url, response)
+    return response
+
+
+def load_jsonl_index(path, key, value=None):
+    # returns dict record[key] -> byte offset of its line (record[value] if value is given) of the append-only
+    # JSONL file at path; later lines replace earlier ones, a truncated last line is cut off the file
+    index = {}
+    if not os.path.exists(path):
+        return index
+    with open(path, 'rb+') as fh:
+        offset = 0
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                fh.truncate(offset)
+                break
+            index[record[key]] = offset if value is None else record[value]
+            offset += len(line)
+    return index
+
+
+def download_jsonl(keys, fetch, path, workers, chunk_size=256):
+    # calls fetch(key) for all keys in a thread pool and appends the record it returns (nothing if None) to
+    # path as one JSON line as soon as it completes, so an interrupted download can resume from the file.
+    # chunk_size keys are submitted at a time, which bounds the number of responses held in memory.
+    # Returns (failed keys, number of records written).
+    failed = []
+    written = 0
+    with open(path, 'ab') as fh, ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(keys), chunk_size):
+            futures = {pool.submit(fetch, key): key for key in keys[start:start + chunk_size]}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    print(f"{futures[future]}: {e}")
+                    failed.append(futures[future])
+                    continue
+                if record is None:
+                    continue
+                fh.write((json.dumps(record) + '\n').encode('utf-8'))
+                written += 1
+            fh.flush()
+            print(start + len(futures))
+    return failed, written
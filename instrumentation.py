@@ -0,0 +1,133 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+
+# Lightweight run instrumentation: named spans (wall time of a stage, batch or request, per thread) and
+# counters (files scanned, bytes read, http requests and retries, cache hits, rows scored). Recording a span
+# or a counter costs a few microseconds, so instrumentation stays on in normal runs; write_report dumps a JSON
+# summary and a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).
+# Spans whose name is in PROFILE_SPANS are additionally profiled with cProfile (or pyinstrument, if
+# PROFILER = 'pyinstrument' and it is installed) and the profile is written to PROFILE_DIR/<span>.prof
+# (.html for pyinstrument).
+
+PROFILE_SPANS = set()  # span names to profile, '*' profiles every top level span
+PROFILER = 'cprofile'
+PROFILE_DIR = os.path.join(os.getcwd(), 'reports', 'profiles')
+
+_lock = threading.Lock()
+_local = threading.local()
+_events = []
+_counters = {}
+_started = time.perf_counter()
+
+
+def reset():
+    global _started
+    with _lock:
+        _events.clear()
+        _counters.clear()
+        _started = time.perf_counter()
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def _profiler(name, depth):
+    if name not in PROFILE_SPANS and not ('*' in PROFILE_SPANS and depth == 0):
+        return None
+    if PROFILER == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            return Profiler()
+        except ImportError:
+            print("pyinstrument is not installed, falling back to cProfile")
+    return cProfile.Profile()
+
+
+def _dump_profile(profiler, name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.dump_stats(path + '.prof')
+    else:
+        with open(path + '.html', 'w', encoding='utf-8') as fh:
+            fh.write(profiler.output_html())
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    # times the enclosed block; args (json serializable) are attached to the trace event
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    profiler = _profiler(name, depth)
+    if profiler is not None:
+        try:
+            profiler.enable() if isinstance(profiler, cProfile.Profile) else profiler.start()
+        except (RuntimeError, ValueError):
+            # another profiler is already active, e.g. the same span profiled in a concurrent thread
+            profiler = None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _local.depth = depth
+        if profiler is not None:
+            profiler.disable() if isinstance(profiler, cProfile.Profile) else profiler.stop()
+            _dump_profile(profiler, name)
+        with _lock:
+            _events.append({'name': name, 'ph': 'X', 'ts': (start - _started) * 1e6, 'dur': (end - start) * 1e6,
+                            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+
+def traced(name=None):
+    # decorator recording every call of the function as a span named name (default: the function name)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    # per span name: number of spans, total and maximum seconds; counters; wall time since the last reset
+    with _lock:
+        events = list(_events)
+        counter_values = dict(_counters)
+    spans = {}
+    for event in events:
+        stats = spans.setdefault(event['name'], {'count': 0, 'total_s': 0.0, 'max_s': 0.0})
+        stats['count'] += 1
+        stats['total_s'] += event['dur'] / 1e6
+        stats['max_s'] = max(stats['max_s'], event['dur'] / 1e6)
+    return {'wall_s': time.perf_counter() - _started, 'spans': spans, 'counters': counter_values}
+
+
+def write_report(report_path, meta=None):
+    # report_path without extension; writes report_path.json (summary) and report_path.trace.json (Chrome trace)
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    report = dict(summary(), meta=meta or {})
+    with open(report_path + '.json', 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=2)
+    with _lock:
+        events = list(_events)
+    now = (time.perf_counter() - _started) * 1e6
+    counter_events = [{'name': name, 'ph': 'C', 'ts': now, 'pid': os.getpid(), 'args': {name: value}}
+                      for name, value in report['counters'].items()]
+    with open(report_path + '.trace.json', 'w', encoding='utf-8') as fh:
+        json.dump({'traceEvents': sorted(events, key=lambda event: event['ts']) + counter_events,
+                   'displayTimeUnit': 'ms'}, fh)
+    return report
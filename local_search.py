@@ -0,0 +1,254 @@
+import json
+import mmap
+import os
+import re
+from collections import OrderedDict
+import numpy as np
+
+# Offline retrieval over mathlib declarations.
+# BM25Index keeps a compact inverted index: one vocabulary (term -> term id), and for every term a slice
+# [offsets[t], offsets[t+1]) of the concatenated posting arrays doc_ids (int32) and tfs (float32).
+# Indexes are stored as a .npz file (numeric arrays only, no pickling) next to a .json file holding the
+# vocabulary and the per-declaration results returned to df_evaluate.
+
+TOKEN_PATTERN = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+')
+
+
+def tokenize(text):
+    # splits identifiers like Nat.add_comm or IsCompact.exists_isMinOn into lowercase word pieces
+    return [token.lower() for token in TOKEN_PATTERN.findall(text)]
+
+
+class BM25Index:
+    def __init__(self, vocabulary, offsets, doc_ids, tfs, doc_lengths, results, fingerprint='', k1=1.2, b=0.75):
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.results = results
+        self.fingerprint = fingerprint
+        self.k1 = k1
+        self.b = b
+        n_docs = len(doc_lengths)
+        doc_freqs = np.diff(offsets)
+        self.idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        # per posting BM25 weight, so that a query only sums precomputed values
+        norm = k1 * (1 - b + b * doc_lengths / max(doc_lengths.mean(), 1))
+        self.weights = (tfs * (k1 + 1) / (tfs + norm[doc_ids])).astype(np.float32)
+
+    @classmethod
+    def build(cls, texts, results, fingerprint=''):
+        # texts: list[str] documents to index, results: list[dict] returned for the matching document
+        vocabulary = {}
+        postings = []
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc_id, text in enumerate(texts):
+            counts = {}
+            for token in tokenize(text):
+                counts[token] = counts.get(token, 0) + 1
+            doc_lengths[doc_id] = sum(counts.values())
+            for token, count in counts.items():
+                term_id = vocabulary.setdefault(token, len(vocabulary))
+                postings.append((term_id, doc_id, count))
+        postings = np.array(postings, dtype=np.int64).reshape(-1, 3)
+        postings = postings[np.lexsort((postings[:, 1], postings[:, 0]))]
+        offsets = np.searchsorted(postings[:, 0], np.arange(len(vocabulary) + 1))
+        return cls(vocabulary, offsets.astype(np.int64), postings[:, 1].astype(np.int32),
+                   postings[:, 2].astype(np.float32), doc_lengths, results, fingerprint)
+
+    def save(self, path):
+        # path without extension; writes path.npz and path.json
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(path + '.npz', offsets=self.offsets, doc_ids=self.doc_ids, tfs=self.tfs,
+                 doc_lengths=self.doc_lengths)
+        with open(path + '.json', 'w', encoding='utf-8') as fh:
+            json.dump({'fingerprint': self.fingerprint, 'vocabulary': self.vocabulary, 'results': self.results}, fh)
+
+    @classmethod
+    def load(cls, path):
+        with open(path + '.json', encoding='utf-8') as fh:
+            meta = json.load(fh)
+        arrays = np.load(path + '.npz', allow_pickle=False)
+        return cls(meta['vocabulary'], arrays['offsets'], arrays['doc_ids'], arrays['tfs'],
+                   arrays['doc_lengths'], meta['results'], meta['fingerprint'])
+
+    def search(self, query, num_results=10):
+        term_ids = {self.vocabulary[token] for token in tokenize(query) if token in self.vocabulary}
+        if not term_ids:
+            return []
+        slices = [slice(self.offsets[t], self.offsets[t + 1]) for t in term_ids]
+        doc_ids = np.concatenate([self.doc_ids[s] for s in slices])
+        weights = np.concatenate([self.weights[s] * self.idf[t] for s, t in zip(slices, term_ids)])
+        candidates, inverse = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        if len(candidates) > num_results:
+            top = np.argpartition(-scores, num_results)[:num_results]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [dict(self.results[candidates[i]], score=float(scores[i])) for i in top]
+
+
+# DenseIndex keeps one L2-normalised embedding per declaration in a raw .npy matrix (float16, or int8 with a
+# float32 scale per row) that is opened with mmap_mode='r': loading only reads the header, and several
+# evaluation processes share one copy of the vectors through the page cache. The .json file only holds
+# the fingerprint, model name and dtype; the results are taken from the same declaration list the index
+# was built from.
+
+class DenseIndex:
+    def __init__(self, vectors, scales, meta, results=None):
+        self.vectors = vectors
+        self.scales = scales
+        self.meta = meta
+        self.results = results
+
+    @classmethod
+    def build(cls, texts, encode, path, meta, dtype='float16', batch_size=256):
+        # encode: list[str] -> float array (n, dim); vectors are written batch by batch into the memory map
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        vectors = None
+        scales = np.ones(len(texts), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            batch = _normalize(np.asarray(encode(texts[start:start + batch_size]), dtype=np.float32))
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(path + '.vectors.npy', mode='w+', dtype=dtype,
+                                                    shape=(len(texts), batch.shape[1]))
+            if dtype == 'int8':
+                row_scales = np.maximum(np.abs(batch).max(axis=1), 1e-12) / 127
+                vectors[start:start + len(batch)] = np.round(batch / row_scales[:, None]).astype(np.int8)
+                scales[start:start + len(batch)] = row_scales
+            else:
+                vectors[start:start + len(batch)] = batch.astype(dtype)
+        vectors.flush()
+        np.save(path + '.scales.npy', scales)
+        meta = dict(meta, dtype=dtype, size=len(texts))
+        with open(path + '.json', 'w', encoding='utf-8') as fh:
+            json.dump(meta, fh)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path + '.json', encoding='utf-8') as fh:
+            meta = json.load(fh)
+        return cls(np.load(path + '.vectors.npy', mmap_mode='r'), np.load(path + '.scales.npy', mmap_mode='r'), meta)
+
+    def search_vectors(self, query_vectors, num_results=10, block_size=65536):
+        # exact top-k by cosine similarity for a batch of queries, scanning the index in blocks of rows
+        # so that memory stays bounded; returns (indices, scores), both of shape (n_queries, k)
+        queries = _normalize(np.asarray(query_vectors, dtype=np.float32))
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.vectors), block_size):
+            block = np.asarray(self.vectors[start:start + block_size], dtype=np.float32)
+            scores = queries @ block.T * self.scales[start:start + len(block)]
+            k = min(num_results, scores.shape[1])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_ids = np.concatenate([best_ids, top + start], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            if best_ids.shape[1] > num_results:
+                keep = np.argpartition(-best_scores, num_results - 1, axis=1)[:, :num_results]
+                best_ids = np.take_along_axis(best_ids, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        return np.take_along_axis(best_ids, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def search(self, query_vectors, num_results=10):
+        ids, scores = self.search_vectors(query_vectors, num_results)
+        return [[dict(self.results[i], score=float(s)) for i, s in zip(row_ids, row_scores)]
+                for row_ids, row_scores in zip(ids, scores)]
+
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+# CodeIndex maps mathlib source positions to byte offsets: the start offset of every line of every file (one
+# concatenated uint32 .npy, memory-mapped on load, file i owning the slice [line_ptr[i], line_ptr[i+1]) with the
+# file size as last entry), and for every named declaration its file and byte span. Code is sliced out of
+# memory-mapped source files, so lookups neither read nor split whole files. The .json file holds the relative
+# paths, line_ptr, the declarations and a fingerprint of the file states the offsets were computed from.
+
+class CodeIndex:
+    def __init__(self, root, paths, line_ptr, line_offsets, declarations, meta, max_open=256):
+        self.root = root
+        self.paths = paths
+        self.file_ids = {path: i for i, path in enumerate(paths)}
+        self.line_ptr = line_ptr
+        self.line_offsets = line_offsets
+        self.declarations = declarations
+        self.meta = meta
+        self.max_open = max_open
+        self._maps = OrderedDict()  # file id -> mmap, least recently used first
+
+    @staticmethod
+    def key(module_name, name):
+        return ".".join(module_name) + " " + name
+
+    @classmethod
+    def build(cls, root, paths, declarations, path, meta):
+        # paths relative to root; declarations: dict key -> (relative path, first line, last line), 1-based
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        line_offsets = []
+        line_ptr = [0]
+        for relative_path in paths:
+            with open(os.path.join(root, relative_path), 'rb') as fh:
+                data = fh.read()
+            starts = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10) + 1
+            starts = np.concatenate([[0], starts[starts < len(data)], [len(data)]]).astype(np.uint32)
+            line_offsets.append(starts)
+            line_ptr.append(line_ptr[-1] + len(starts))
+        line_offsets = np.concatenate(line_offsets) if line_offsets else np.zeros(0, dtype=np.uint32)
+        file_ids = {relative_path: i for i, relative_path in enumerate(paths)}
+        spans = {}
+        for key, (relative_path, first, last) in declarations.items():
+            file_id = file_ids[relative_path]
+            spans[key] = [file_id, *cls._byte_span(line_ptr, line_offsets, file_id, first, last)]
+        np.save(path + '.lines.npy', line_offsets)
+        with open(path + '.json', 'w', encoding='utf-8') as fh:
+            json.dump({'paths': paths, 'line_ptr': line_ptr, 'declarations': spans, 'meta': meta}, fh)
+        return cls.load(path, root)
+
+    @classmethod
+    def load(cls, path, root):
+        with open(path + '.json', encoding='utf-8') as fh:
+            stored = json.load(fh)
+        return cls(root, stored['paths'], stored['line_ptr'], np.load(path + '.lines.npy', mmap_mode='r'),
+                   stored['declarations'], stored['meta'])
+
+    @staticmethod
+    def _byte_span(line_ptr, line_offsets, file_id, first, last):
+        # byte span of lines first..last (1-based, inclusive), clipped like lines[first-1:last]
+        starts = line_offsets[line_ptr[file_id]:line_ptr[file_id + 1]]
+        n_lines = len(starts) - 1
+        first = min(max(first - 1, 0), n_lines)
+        last = min(max(last, first), n_lines)
+        return int(starts[first]), int(starts[last])
+
+    def _map(self, file_id):
+        if file_id in self._maps:
+            self._maps.move_to_end(file_id)
+            return self._maps[file_id]
+        with open(os.path.join(self.root, self.paths[file_id]), 'rb') as fh:
+            # empty files cannot be memory-mapped
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(fh.fileno()).st_size else b''
+        self._maps[file_id] = data
+        if len(self._maps) > self.max_open:
+            _, old = self._maps.popitem(last=False)
+            if isinstance(old, mmap.mmap):
+                old.close()
+        return data
+
+    def _slice(self, file_id, start, end):
+        # same text as reading the file in text mode
+        return self._map(file_id)[start:end].decode('utf-8').replace('\r\n', '\n')
+
+    def lines(self, path, first, last):
+        # lines first..last (1-based, inclusive) of the file at path relative to root
+        file_id = self.file_ids[path]
+        return self._slice(file_id, *self._byte_span(self.line_ptr, self.line_offsets, file_id, first, last))
+
+    def declaration_code(self, module_name, name):
+        # code of the declaration `name` (full name) in module_name (e.g. ['Mathlib', 'Algebra', 'Group', 'Basic'])
+        file_id, start, end = self.declarations[self.key(module_name, name)]
+        return self._slice(file_id, start, end)
@@ -1,19 +1,47 @@
+import hashlib
+import inspect
+import io
+import json
 import os
 import re
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import bibtexparser
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import unquote, urlparse
 import mwparserfromhell
+import numpy as np
 import yaml
+from lxml import etree
+try:
+    # optional (python -m pip install pyahocorasick): finds all retrieved signatures in a gold code in one scan
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 import argparse
+from dataset_io import content_fingerprint, read_cached, read_dataset, resolve_dataset, write_cached
+import instrumentation
+from instrumentation import count, span, traced
+from http_utils import RateLimiter, make_session, request_with_retry
+from local_search import BM25Index, CodeIndex, DenseIndex
+from metrics import per_query_metrics, write_report
 
 
 
 # Configuration #DELETE!!
 HOME = os.getcwd()
 MATHLIB4_LOC = os.path.join(HOME,'mathlib4')
+CACHE_DIR = os.path.join(HOME,'cache')
+SCAN_INDEX_PATH = os.path.join(CACHE_DIR,'mathlib_scan.sqlite')
+# wikitext and revision id of every fetched wikipedia page; only pages with a new revision are downloaded again
+WIKI_STORE_PATH = os.path.join(CACHE_DIR,'wikipedia_pages.sqlite')
+# processed version of mathlib's refs.bib with zbl_ids added
+BIB_PATH = os.path.join(HOME,'references_with_zbl.bib')
+WIKI_PARSE_WORKERS = None  # processes extracting theorem sections from wikitext (None: one per cpu)
 USER_AGENT = "Test Theorem Retrieval (your@username.com)"
 REQUEST_DELAY = 1  # seconds between requests to avoid rate limiting
 WIKI_API_URL = "https://en.wikipedia.org/w/api.php"
@@ -21,6 +49,32 @@ SE_API_URL = "https://api.stackexchange.com/2.3/questions"
 WIKIDATA_PREFIX = 'https://www.wikidata.org/wiki/'
 HEADERS = {"User-Agent": USER_AGENT}
 mathlib_url = 'https://github.com/leanprover-community/mathlib4/tree/ed96f50f75b1f89c4561f2ba2d837eb169052094/'
+LEAN_SEARCH_URL = 'https://leansearch.net/search'
+LEAN_SEARCH_BATCH_SIZE = 10
+LEAN_SEARCH_WORKERS = 4  # batches in flight
+LEAN_SEARCH_RATE = 2  # batches per second
+LEAN_SEARCH_TIMEOUT = 120  # seconds
+MAX_QUERY_CHARS = 19000  # queries are truncated to this length before retrieval
+RETRIEVAL_CACHE_PATH = os.path.join(CACHE_DIR,'retrieval_cache.sqlite')
+RETRIEVAL_CACHE_MAX_ENTRIES = 500000
+RETRIEVAL_REPLAY_ONLY = False  # only serve cached retrieval results, never call the retriever
+# local retrievers answer from indexes rebuilt with every mathlib4 change, so their results are never cached
+UNCACHED_RETRIEVERS = {'bm25_search', 'dense_search'}
+REPORT_DIR = os.path.join(HOME,'reports')
+# zbmath abstracts joined with the modules citing them, shared by both zbmath evaluations
+ZBMATH_DATASET_PATH = os.path.join(CACHE_DIR,'zbmath_dataset.parquet')
+ZBMATH_DATASET_VERSION = 1
+BM25_INDEX_PATH = os.path.join(CACHE_DIR,'bm25_mathlib')
+AUGMENT_DEPTH = 1  # levels of cited stacks statements inlined into informal statements and proofs
+AUGMENT_MAX_TOKENS = None  # token budget of every inlined statement
+# stacks content converted to text, split into statement and proof, is stored next to the dataset
+# (stacks_project_text.parquet) and recomputed only when the dataset file changes
+STACKS_TEXT_WORKERS = None  # processes converting stacks html to text (None: one per cpu)
+STACKS_TEXT_VERSION = 1
+DENSE_INDEX_PATH = os.path.join(CACHE_DIR,'dense_mathlib')
+CODE_INDEX_PATH = os.path.join(CACHE_DIR,'code_mathlib')
+DENSE_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+DENSE_DTYPE = 'float16'  # or 'int8'
 
 
 PROPERTY_DICT = {"QID":"qid","Label":"Len",
@@ -48,29 +102,99 @@ KEYS_FOR_FORMAL_PROOFS = {"Len":"",
 
 #### Handle wikipedia theorems specifically
 
+def _open_wiki_store(store_path=WIKI_STORE_PATH):
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    con = sqlite3.connect(store_path)
+    con.execute('CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, revid INTEGER, wikitext TEXT)')
+    con.execute('CREATE TABLE IF NOT EXISTS sections (title TEXT, revid INTEGER, section_info TEXT, content TEXT, '
+                'PRIMARY KEY (title, revid, section_info))')
+    return con
+
+def _fetch_wiki_batch(batch, session, con):
+    # revision-aware fetch: one cheap query for the current revision ids (and normalizations/redirects),
+    # then the wikitext of only those pages whose revid differs from the stored one.
+    # returns the API response of the first query with the wikitext filled in from the store
+    params = {
+        "action": "query",
+        "format": "json",
+        "prop": "revisions",
+        "rvprop": "ids",
+        "titles": "|".join(batch),
+        "redirects": 1
+    }
+    data = request_with_retry(session, 'POST', WIKI_API_URL, data=params, timeout=30).json()
+    pages = data.get("query", {}).get("pages", {})
+    titles = [page_data['title'] for page_data in pages.values() if page_data.get('revisions')]
+    stored = {title: (revid, wikitext) for title, revid, wikitext in con.execute(
+        f"SELECT title, revid, wikitext FROM pages WHERE title IN ({','.join('?' * len(titles))})", titles)}
+    changed = [page_data['title'] for page_data in pages.values() if page_data.get('revisions')
+               and stored.get(page_data['title'], (None,))[0] != page_data['revisions'][0]['revid']]
+    count('wiki_pages_downloaded', len(changed))
+    if changed:
+        params.update({"rvprop": "ids|content", "titles": "|".join(changed)})
+        changed_pages = request_with_retry(session, 'POST', WIKI_API_URL, data=params, timeout=30).json()
+        with con:
+            for page_data in changed_pages.get("query", {}).get("pages", {}).values():
+                if page_data.get('revisions'):
+                    revision = page_data['revisions'][0]
+                    stored[page_data['title']] = (revision['revid'], revision.get('*'))
+                    con.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+                                (page_data['title'], revision['revid'], revision.get('*')))
+    for page_data in pages.values():
+        if page_data.get('revisions') and page_data['title'] in stored:
+            page_data['revisions'][0]['*'] = stored[page_data['title']][1]
+    return data
+
+def _extract_wiki_section(raw_text, section_info):
+    # --- LOCAL PARSING ---
+    # Parse the text into a tree object
+    wikicode = mwparserfromhell.parse(raw_text)
+
+    # Find section by heading name (case-insensitive usually preferred)
+    # matches=... does a regex match on the heading title
+    if section_info:
+        theorem_sections = wikicode.get_sections(matches=section_info)
+    else:
+        theorem_sections = wikicode.get_sections(matches=r"(?i)^Theorem|Statement|Formulation|Formal Statement|Definition$")
+
+    if theorem_sections:
+        # Pure section content (no heading text, no == == markup)
+        content = theorem_sections[0].strip_code()  # plain text
+        # content = str(theorem_sections[0])                # ← uncomment if you want to keep wikitext
+    else:
+        # Fallback: the lead/introductory section (the article summary)
+        lead = wikicode.get_sections(
+            include_lead=True,
+            include_headings=False  # harmless for lead, keeps API consistent
+        )[0]
+        content = lead.strip_code()  # plain text
+        # content = str(lead)                               # ← keep wikitext if preferred
+
+    return content if content.strip() else ''  # optional: treat empty as None
+
+@traced()
 def get_theorems_bulk(titles):
     results = []
     # Wikipedia allows up to 50 titles per API call
     BATCH_SIZE = 50
+    session = make_session(1, HEADERS)
+    con = _open_wiki_store()
+    # fetching stays in this thread, section extraction runs in a process pool; results are reassembled
+    # in title order and the parsed sections are cached per page revision
+    pool = ProcessPoolExecutor(max_workers=WIKI_PARSE_WORKERS)
+    pending = {}
 
     for i in range(0, len(titles), BATCH_SIZE):
         batch = titles[i: i + BATCH_SIZE]
         # print(f"Fetching batch {i} to {i + len(batch)}...")
 
-        params = {
-            "action": "query",
-            "format": "json",
-            "prop": "revisions",
-            "rvprop": "content",  # Get the raw wikitext
-            "titles": "|".join(batch),
-            "redirects": 1
-        }
-
         try:
-            r = requests.post(WIKI_API_URL, data=params, headers=HEADERS, timeout=30)
-            data = r.json()
+            with span('wiki_fetch_batch', titles=len(batch)):
+                data = _fetch_wiki_batch(batch, session, con)
         except Exception as e:
             print(f"Error fetching batch: {e}")
+            # keep results aligned with titles
+            results += [''] * len(batch)
             continue
         if data['query'].get('normalized'):
             normalizations_dict = {it['from']:it['to'] for it in data['query']['normalized']}
@@ -99,190 +223,616 @@ def get_theorems_bulk(titles):
             page_data = pages.get(page_id)
 
             # Handle missing pages or redirects that failed
-            if "missing" in page_data:
+            if page_data is None or "missing" in page_data:
                 results.append('')
                 continue
 
             # Extract the raw wikitext
             try:
-                raw_text = page_data["revisions"][0]["*"]
+                revision = page_data["revisions"][0]
+                raw_text = revision["*"]
             except (KeyError, IndexError):
                 results.append('')
                 continue
+            if raw_text is None:
+                results.append('')
+                continue
 
-            # --- LOCAL PARSING ---
-            # Parse the text into a tree object
-            wikicode = mwparserfromhell.parse(raw_text)
-
-            # Find section by heading name (case-insensitive usually preferred)
-            # matches=... does a regex match on the heading title
-            if b['section_info']:
-                theorem_sections = wikicode.get_sections(matches=b['section_info'])
+            key = (page_data['title'], revision['revid'], b['section_info'] or '')
+            cached = con.execute('SELECT content FROM sections WHERE title = ? AND revid = ? AND section_info = ?',
+                                 key).fetchone()
+            if cached:
+                count('wiki_sections_cached')
+                results.append(cached[0])
             else:
-                theorem_sections = wikicode.get_sections(matches=r"(?i)^Theorem|Statement|Formulation|Formal Statement|Definition$")
+                # parsed in the process pool while the next batches are fetched
+                pending[len(results)] = key
+                results.append(pool.submit(_extract_wiki_section, raw_text, b['section_info']))
+
+    count('wiki_sections_parsed', len(pending))
+    with con:
+        for position, key in pending.items():
+            results[position] = results[position].result()
+            con.execute('INSERT OR REPLACE INTO sections VALUES (?, ?, ?, ?)', key + (results[position],))
+    pool.shutdown()
+    con.close()
+    return results
+
 
-            if theorem_sections:
-                # Pure section content (no heading text, no == == markup)
-                content = theorem_sections[0].strip_code()  # plain text
-                # content = str(theorem_sections[0])                # ← uncomment if you want to keep wikitext
+#### Mathlib corpus scan
+# Every .lean file is read exactly once; bibrefs, wikilinks, @[stacks ...] blocks and declaration
+# spans are extracted together and shared by all evaluators through _MATHLIB_SCANS.
+# Per-file results are additionally kept in a sqlite index so that re-scans only parse changed files.
+# attribute lists such as @[simp] or @[to_additive (attr := simp) "doc"] written before a declaration
+ATTRIBUTES_PATTERN = re.compile(r'^(?:@\[(?:[^\[\]]|\[[^\]]*\])*\]\s*)+')
+DECLARATION_PATTERN = re.compile(
+    r'^(?:@\[(?:[^\[\]]|\[[^\]]*\])*\]\s*)*'
+    r'(?:(?:private|protected|noncomputable|nonrec|unsafe|partial|local|scoped(?:\[[^\]]*\])?)\s+)*'
+    r'(theorem|lemma|def|abbrev|instance|structure|class|inductive|alias|irreducible_def|opaque)\b'
+    r'\s*([^\s(:{\[⟨]*)')
+SCOPE_PATTERN = re.compile(r'^(?:noncomputable\s+)?(namespace|section)\b\s*(\S*)')
+_MATHLIB_SCANS = {}
+_LOCAL_INDEXES = {}
+_MATHLIB_DECLARATIONS = {}
+_BIB_INDEXES = {}
+# bump whenever the extraction logic changes so that stale index entries are re-parsed
+SCAN_VERSION = 3
+UNCHANGED = 'unchanged'
+
+
+def _extract_file_references(mathlib_file):
+    # are given under after a line ## References
+    mathlib_file_sp = mathlib_file.split('## ')
+    for line in mathlib_file_sp:
+        if line.startswith('References'):
+            endcomment = re.search('-/',line)
+            line = line[:endcomment.start()] if endcomment else line[:]
+            # References following mathlib's refs.bib file follow the pattern [ref_identifier]
+            line_bibrefs = re.findall(r'\[\S+\]',line)
+            # Matches links in general
+            line_wikilinks = re.findall(r'http\S+[A-Za-z\d]',line)
+            line_wikilinks = [link+')' if '(' in link and not ')' in link else link for link in line_wikilinks ]
+            if line_bibrefs or line_wikilinks:
+                return {'bibrefs':line_bibrefs,'wikilinks':line_wikilinks}
+            return None
+    return None
+
+
+def _extract_file_stacks_blocks(lines):
+    # blocks start at a line '@[stacks TAG "comment"]' and end at the next empty line
+    blocks = []
+    block = None
+    for i in range(len(lines)):
+        line = lines[i]
+        if line.startswith('@[stacks'):
+            block = {'tag': line[len('@[stacks '):len('@[stacks ')+4],
+                     'comment': line[len('@[stacks ')+5:-2].replace('"',''),
+                     'code': [], 'lines': f"#L{i+2}"}
+            blocks.append(block)
+        elif block is not None:
+            if not line.strip():
+                block['lines'] += f"-L{i}"
+                block = None
             else:
-                # Fallback: the lead/introductory section (the article summary)
-                lead = wikicode.get_sections(
-                    include_lead=True,
-                    include_headings=False  # harmless for lead, keeps API consistent
-                )[0]
-                content = lead.strip_code()  # plain text
-                # content = str(lead)                               # ← keep wikitext if preferred
-
-            results.append(content if content.strip() else '')  # optional: treat empty as None
-    return results
+                block['code'].append(line)
+    for block in blocks:
+        block['code'] = "".join(block['code'])
+    return blocks
+
+
+def _extract_file_declarations(lines):
+    # returns list[dict] with full name (including the open namespaces), kind, docstring, signature
+    # (everything before the first ':=') and 1-based line span (up to the next empty line)
+    declarations = []
+    declaration = None
+    docstring = []
+    in_docstring = False
+    comment_depth = 0  # nesting depth of the /- ... -/ block comment the line is in
+    scopes = []  # one list of name components per open namespace/section
+    for i, line in enumerate(lines):
+        if in_docstring:
+            docstring.append(line)
+            in_docstring = '-/' not in line
+            continue
+        if declaration is not None and not line.strip():
+            declaration['line_end'] = i
+            declaration = None
+        if comment_depth:
+            comment_depth += line.count('/-') - line.count('-/')
+            continue
+        if line.startswith('/--'):
+            docstring = [line]
+            in_docstring = '-/' not in line[3:]
+            continue
+        if line.startswith('/-'):
+            comment_depth = line.count('/-') - line.count('-/')
+            docstring = []
+            continue
+        scope = SCOPE_PATTERN.match(line)
+        if scope:
+            scopes.append(scope.group(2).split('.') if scope.group(1) == 'namespace' and scope.group(2) else [])
+        elif line.startswith('end') and line[3:4] in ('', ' ', '\n') and scopes:
+            scopes.pop()
+        match = DECLARATION_PATTERN.match(line)
+        if match:
+            if declaration is not None:
+                declaration['line_end'] = i
+            doc = "".join(docstring).strip()
+            name = match.group(2)
+            if name.startswith('_root_.'):
+                name = name[len('_root_.'):]
+            elif name:
+                name = ".".join([part for scope in scopes for part in scope] + [name])
+            declaration = {'name': name, 'kind': match.group(1),
+                           'doc': doc[3:-2].strip() if doc.endswith('-/') else doc,
+                           'line_start': i+1, 'line_end': len(lines)}
+            declarations.append(declaration)
+            docstring = []
+        elif not line.startswith('@['):
+            docstring = []
+    for declaration in declarations:
+        code = ATTRIBUTES_PATTERN.sub('', "".join(lines[declaration['line_start']-1:declaration['line_end']]))
+        declaration['signature'] = " ".join(code.split(':=')[0].split())
+    return declarations
+
+
+def _scan_lean_file(path, known_sha1=None):
+    # returns (sha1, result); result is UNCHANGED if the content hash equals known_sha1
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+    except OSError:
+        print(path)
+        return None, None
+    sha1 = hashlib.sha1(data).hexdigest()
+    if sha1 == known_sha1:
+        return sha1, UNCHANGED
+    try:
+        # same newline translation as reading the file in text mode
+        mathlib_file = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    except UnicodeDecodeError:
+        print(path)
+        return sha1, None
+    lines = io.StringIO(mathlib_file).readlines()
+    return sha1, {'references': _extract_file_references(mathlib_file),
+                  'stacks': _extract_file_stacks_blocks(lines),
+                  'declarations': _extract_file_declarations(lines)}
+
+
+def _list_lean_files(mathlib_loc):
+    return [os.path.join(dirpath, filename)
+            for dirpath, dirnames, filenames in os.walk(mathlib_loc)
+            for filename in filenames if filename.endswith('.lean')]
+
+
+def _open_scan_index(index_path):
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    con = sqlite3.connect(index_path)
+    con.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, '
+                'sha1 TEXT, version INTEGER, result TEXT)')
+    return con
+
+
+@traced()
+def scan_mathlib(mathlib_loc=MATHLIB4_LOC, workers=None, refresh=False, index_path=SCAN_INDEX_PATH):
+    # walks mathlib4 once and parses all lean files in a process pool
+    # returns dict[dict] keys are filepaths (in os.walk order), values as returned by _scan_lean_file
+    # Results are persisted per file in the sqlite index at index_path (None disables it): files whose
+    # mtime and size are unchanged are not read at all, files whose content hash is unchanged are not
+    # parsed again, and only the remaining ones are sent to the process pool.
+    if not refresh and mathlib_loc in _MATHLIB_SCANS:
+        return _MATHLIB_SCANS[mathlib_loc]
+    paths = _list_lean_files(mathlib_loc)
+    stats = {path: os.stat(path) for path in paths}
+    indexed = {}
+    if index_path:
+        con = _open_scan_index(index_path)
+        indexed = {row[0]: row[1:] for row in con.execute(
+            'SELECT path, mtime_ns, size, sha1, result FROM files WHERE version = ?', (SCAN_VERSION,))}
+
+    count('files_listed', len(paths))
+    results = {}
+    stale = []
+    for path in paths:
+        row = indexed.get(path)
+        if row and row[0] == stats[path].st_mtime_ns and row[1] == stats[path].st_size:
+            results[path] = json.loads(row[3])
+        else:
+            stale.append(path)
+
+    count('files_read', len(stale))
+    count('bytes_read', sum(stats[path].st_size for path in stale))
+    updates = []
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            scanned = pool.map(_scan_lean_file, stale,
+                               [indexed[path][2] if path in indexed else None for path in stale],
+                               chunksize=32)
+            for path, (sha1, result) in zip(stale, scanned):
+                if sha1 is None:
+                    continue
+                if result == UNCHANGED:
+                    result = json.loads(indexed[path][3])
+                else:
+                    count('files_parsed')
+                results[path] = result
+                updates.append((path, stats[path].st_mtime_ns, stats[path].st_size, sha1, SCAN_VERSION,
+                                json.dumps(result)))
+
+    if index_path:
+        with con:
+            con.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', updates)
+            removed = [(path,) for path, in con.execute('SELECT path FROM files')
+                       if path.startswith(mathlib_loc) and path not in stats]
+            con.executemany('DELETE FROM files WHERE path = ?', removed)
+        con.close()
+
+    _MATHLIB_SCANS[mathlib_loc] = {path: results[path] for path in paths if results.get(path) is not None}
+    return _MATHLIB_SCANS[mathlib_loc]
 
 
 #### Mathlib References
 def extract_references():
     # extracts references from all lean files in mathlib4
     # returns dict[dict[list]]] keys are filepaths
-    files_w_refs = {}
-    for dirpath, dirnames, filenames in os.walk(os.path.join(HOME,'mathlib4')):
-        for filename in filenames:
-            if not filename.endswith('.lean'):
-                continue
-            with open(os.path.join(dirpath,filename), encoding='utf-8') as fh:
-                try:
-                    mathlib_file = fh.read()
-                except:
-                    print(os.path.join(dirpath,filename))
-            # are given under after a line ## References
-            mathlib_file_sp = mathlib_file.split('## ')
-            for line in mathlib_file_sp:
-                if line.startswith('References'):
-                    endcomment = re.search('-/',line)
-                    line = line[:endcomment.start()] if endcomment else line[:]
-                    # References following mathlib's refs.bib file follow the pattern [ref_identifier]
-                    line_bibrefs = re.findall(r'\[\S+\]',line)
-                    # Matches links in general
-                    line_wikilinks = re.findall(r'http\S+[A-Za-z\d]',line)
-                    line_wikilinks = [link+')' if '(' in link and not ')' in link else link for link in line_wikilinks ]
-                    if line_bibrefs or line_wikilinks:
-                        files_w_refs[os.path.join(dirpath,filename)] = {'bibrefs':line_bibrefs,'wikilinks':line_wikilinks}
-                    break
-    return files_w_refs
-
-def match_bibrefs_to_bib_file(books_ok=False):
+    return {path: result['references'] for path, result in scan_mathlib().items()
+            if result['references']}
+
+def load_bib_index(bib_path=BIB_PATH):
+    # ID -> (ENTRYTYPE, zbl_new or None) of the first entry with that ID. The bib file is parsed once per
+    # content and the index is kept next to it (<bib_path>.index.json) for later runs.
+    with open(bib_path, 'rb') as fh:
+        sha1 = hashlib.sha1(fh.read()).hexdigest()
+    if _BIB_INDEXES.get(bib_path, (None,))[0] == sha1:
+        return _BIB_INDEXES[bib_path][1]
+    index_path = bib_path + '.index.json'
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path, encoding='utf-8') as fh:
+            stored = json.load(fh)
+        if stored.get('sha1') == sha1:
+            index = {key: tuple(value) for key, value in stored['entries'].items()}
+    if index is None:
+        with open(bib_path, encoding='utf-8') as fh:
+            bibtex = bibtexparser.load(fh)
+        index = {}
+        for entry in bibtex.entries:
+            index.setdefault(entry['ID'], (entry['ENTRYTYPE'], entry.get('zbl_new')))
+        with open(index_path, 'w', encoding='utf-8') as fh:
+            json.dump({'sha1': sha1, 'entries': index}, fh)
+    _BIB_INDEXES[bib_path] = sha1, index
+    return index
+
+@traced()
+def bib_zbl_references(bib_path=BIB_PATH):
+    # one pass over the references of all mathlib files
+    # returns: dict[list[(zbl_id, entry type)]] keys are filepaths, cited bib entries with a zbl_new identifier
+    index = load_bib_index(bib_path)
+    zbl_references = {}
+    for key, references in extract_references().items():
+        #remove bracket from reference text and match these to the bib entries
+        entries = [index.get(id_w_brackets[1:-1]) for id_w_brackets in references['bibrefs']]
+        entries = [(zbl_id, entrytype) for entrytype, zbl_id in filter(None, entries) if zbl_id is not None]
+        if entries:
+            zbl_references[key] = entries
+    return zbl_references
+
+@traced()
+def match_bibrefs_to_bib_file(books_ok=False, zbl_references=None):
     # Extracts zbl_ids from retrieved mathlib references
     # returns: dict[list] keys are filepaths
-    files_w_refs = extract_references()
-    # This is a processed file, with zbl_ids added compared to mathlib's default refs.bib file
-    bibtex = bibtexparser.load(open(os.path.join(HOME,'references_with_zbl.bib'),encoding='utf-8'))
-    bibtex_entries = bibtex.entries
-    #collection of all identifiers in the bib file
-    bibtex_ids = [entry['ID'] for entry in bibtex.entries]
-    nonbooks_w_zbl = {}
-    for key in files_w_refs.keys():
-        #remove bracket from reference text
-        ids = [id_w_brackets[1:-1] for id_w_brackets in files_w_refs[key]['bibrefs']]
-        #match these to the collected ones
-        bibtex_pos = [bibtex_ids.index(id) for id in ids if id in bibtex_ids]
-        bibtex_pos = [i for i in bibtex_pos if 'zbl_new' in bibtex_entries[i].keys()]
-        if not books_ok:
-            bibtex_pos = [i for i in bibtex_pos if not bibtex_entries[i]['ENTRYTYPE']=='book']
-
-        nonbooks_w_zbl[key] = [bibtex_entries[i]['zbl_new'] for i in bibtex_pos]
-        if not nonbooks_w_zbl[key]:
-            nonbooks_w_zbl.pop(key)
-    return nonbooks_w_zbl
+    # zbl_references as returned by bib_zbl_references, pass it to derive both views from one pass
+    if zbl_references is None:
+        zbl_references = bib_zbl_references()
+    matched = {key: [zbl_id for zbl_id, entrytype in entries if books_ok or entrytype != 'book']
+               for key, entries in zbl_references.items()}
+    return {key: zbl_ids for key, zbl_ids in matched.items() if zbl_ids}
 
 
 
 
 ###Stacks attribute
+# dotted stacks project references like 10.5.2 in informal statements and proofs
+REFERENCE_PATTERN = re.compile(r'(?:\d+\.)+\d+')
+@traced()
 def extract_stacks_attribute_refs():
     # we identify lines of mathlib4 code which reference the stacks project using the
     # @stacks tag returns list[dict], items containing tags, lean code, and tailor-made for import \
     # into mardi
     files_w_refs = {}
-    # j =0
-    for dirpath, dirnames, filenames in os.walk(os.path.join(HOME,'mathlib4')):
-        for filename in filenames:
-            if not filename.endswith('.lean'):
-                continue
-            # j+=1
-            # if j%100==0:
-            #     print(filename)
-            with open(os.path.join(dirpath,filename), encoding='utf-8') as fh:
-                try:
-                    mathlib_file = fh.readlines()
-                except:
-                    print(os.path.join(dirpath,filename))
-            part_of_stacks_thm = False
-            for i in range(len(mathlib_file)):
-                line = mathlib_file[i]
-                if line.startswith('@[stacks'):
-                    part_of_stacks_thm = True
-                    stacks_tag = line[len('@[stacks '):len('@[stacks ')+4]
-                    stacks_comment = line[len('@[stacks ')+5:-2].replace('"','')
-                    files_w_refs[(stacks_tag, stacks_comment)] = {'code':"",'url':''}
-                    files_w_refs[(stacks_tag,stacks_comment)]['url'] = (
-                            os.path.join(dirpath,filename)[len(os.path.join(HOME,'mathlib4')):]
-                            +f"#L{i+2}").replace(os.path.sep,'/')
-                elif part_of_stacks_thm:
-                    if not line.strip():
-                        files_w_refs[(stacks_tag,stacks_comment)]['url'] += f"-L{i}"
-                        part_of_stacks_thm = False
-                    else:
-                        files_w_refs[(stacks_tag,stacks_comment)]['code'] += line
+    for path, result in scan_mathlib().items():
+        for block in result['stacks']:
+            files_w_refs[(block['tag'], block['comment'])] = {
+                'code': block['code'],
+                'url': (path[len(MATHLIB4_LOC):] + block['lines']).replace(os.path.sep,'/')}
 
-        stacks_dict = [{'stacks tag': key[0], 'code': files_w_refs[key]['code'], 'Len': f'Formal Proof of Stacks Project Tag {key[0]}', 'Den': key[1],
-                        'url':  mathlib_url+
-                                 files_w_refs[key]['url']} for key in files_w_refs.keys()]
+    stacks_dict = [{'stacks tag': key[0], 'code': files_w_refs[key]['code'], 'Len': f'Formal Proof of Stacks Project Tag {key[0]}', 'Den': key[1],
+                    'url':  mathlib_url+
+                             files_w_refs[key]['url']} for key in files_w_refs.keys()]
 
     return stacks_dict
 
-def augment_informal_proof(proof,df):
-    offset = 0
+def reference_statements(df):
+    # reference -> statement of the first tag with that reference, built once per stacks dataframe
+    references = df.drop_duplicates(subset='reference', keep='first')
+    return dict(zip(references['reference'], references['statement']))
+
+def augment_informal_proof(proof,statements):
+    # appends " [[statement]]" after every dotted reference (e.g. Lemma 10.5.2) in a single re.sub pass
+    # statements: dict as returned by reference_statements (or the stacks dataframe itself)
+    if isinstance(statements, pd.DataFrame):
+        statements = reference_statements(statements)
+
+    def _augment(match):
+        augment_statement = statements.get(match.group(0))
+        if augment_statement is None:
+            print(match.group(0))
+            print(proof)
+            augment_statement = ''
+        return match.group(0) + " [[" + augment_statement + "]]"
+
     # for match in re.finditer('Lemma ((\d+\.)+\d+)|Proposition ((\d+\.)+\d+)|Theorem ((\d+\.)+\d+)|Equation ((\d+\.)+\d+)',proof):
-    for match in re.finditer(
-            '((\d+\.)+\d+)', proof):
-        for group in match.groups():
-            if group and re.match('(\d+\.)+\d+',group):
-                try:
-                    augment_statement = df[df['reference']==group].statement.values[0]
-                except:
-                    print(group)
-                    print(proof)
-                    augment_statement = ''
-                break
-        proof = (proof[:match.end()+offset] + " [[" +
-                 augment_statement + "]]" +
-                proof[match.end()+offset:])
-        offset += len(" [[" +
-                 augment_statement + "]]")
-    return proof
-
-def lean_search(df,column, new_col_name = 'lean_search'):
+    return REFERENCE_PATTERN.sub(_augment, proof)
+
+def _truncate_tokens(text, max_tokens):
+    # keeps the first max_tokens whitespace separated tokens of text (all of it for max_tokens=None),
+    # closing any inlined statement " [[..." the cut falls into
+    if max_tokens is None:
+        return text
+    for i, token in enumerate(re.finditer(r'\S+', text)):
+        if i == max_tokens:
+            text = text[:token.start()].rstrip()
+            return text + "]]" * (text.count("[[") - text.count("]]"))
+    return text
+
+@traced()
+def expand_statements(statements, depth=1, max_tokens=None):
+    # returns reference -> statement in which cited statements are inlined recursively, `depth` levels deep
+    # (depth=0 returns the statements unchanged), every expansion cut to max_tokens tokens.
+    # Each (reference, depth) is expanded once and shared by all statements citing it. A citation of a
+    # reference that is already being expanded further up is left as is, and only expansions that did not
+    # hit such a cycle are memoized, since their text does not depend on the citing chain.
+    memo = {}
+
+    def _expand(reference, depth, stack):
+        if (reference, depth) in memo:
+            return memo[(reference, depth)], False
+        statement = statements[reference]
+        cut = False
+        if depth > 0:
+            def _augment(match):
+                nonlocal cut
+                cited = match.group(0)
+                if cited == reference:
+                    return cited
+                if cited not in statements:
+                    return cited + " [[]]"
+                if cited in stack:
+                    cut = True
+                    return cited
+                inner, inner_cut = _expand(cited, depth - 1, stack | {cited})
+                cut = cut or inner_cut
+                return cited + " [[" + inner + "]]"
+            statement = REFERENCE_PATTERN.sub(_augment, statement)
+        statement = _truncate_tokens(statement, max_tokens)
+        if not cut:
+            memo[(reference, depth)] = statement
+        return statement, cut
+
+    return {reference: _expand(reference, depth, frozenset([reference]))[0] for reference in statements}
+
+_HTML_PARSER = etree.HTMLParser()
+
+def _html_to_text(content):
+    # same text as BeautifulSoup(content, features="lxml").text (comments and script/style contents are
+    # dropped) without building a BeautifulSoup tree
+    root = etree.fromstring(content, _HTML_PARSER)
+    if root is None:
+        return BeautifulSoup(content, features="lxml").text
+    etree.strip_elements(root, 'script', 'style', 'template', with_tail=False)
+    return ''.join(root.itertext())
+
+def _stacks_text(content):
+    # content as stored in stacks_project.csv (b'...') -> (text, statement, proof), split before 'Proof.'
+    text = _html_to_text(content)[2:-1]
+    statement, found, proof = text.partition('Proof.')
+    return text, statement.strip(), (found + proof).strip()
+
+@traced()
+def load_stacks_texts(path, workers=STACKS_TEXT_WORKERS):
+    # stacks dataset with content converted to text and statement/proof columns
+    df = read_dataset(path, encoding='utf-8')
+    text_path = os.path.splitext(path)[0] + '_text.parquet'
+    fingerprint = content_fingerprint(path, STACKS_TEXT_VERSION)
+    texts = read_cached(text_path, fingerprint)
+    if texts is not None:
+        count('stacks_texts_cached', len(texts))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            texts = pd.DataFrame(pool.map(_stacks_text, df['content'].to_list(), chunksize=256),
+                                 columns=['content', 'statement', 'proof'])
+        count('stacks_texts_converted', len(texts))
+        write_cached(texts, text_path, fingerprint)
+    for column in texts.columns:
+        df[column] = texts[column].to_numpy()
+    return df
+
+class PartialRetrievalError(RuntimeError):
+    # raised by a retriever that answered only part of the queries; results maps row position -> response
+    # of the answered rows, so that cached_retrieval can store them before re-raising
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
 
+@traced()
+def lean_search(df,column, new_col_name = 'lean_search', num_results=10,
+                workers=LEAN_SEARCH_WORKERS, rate=LEAN_SEARCH_RATE):
+    # keeps up to `workers` batches in flight over keep-alive connections, at most `rate` batches
+    # per second; every batch is retried with backoff and results are reassembled in row order.
     texts = df[column].to_list()
-    response_jsons_full = []
     headers = {
         'accept': 'application/json',
         # Already added when you pass json=
         # 'Content-Type': 'application/json',
         'User-Agent': USER_AGENT,
     }
-    for i in range(len(texts)//10+1):
+    batches = [texts[i:i + LEAN_SEARCH_BATCH_SIZE] for i in range(0, len(texts), LEAN_SEARCH_BATCH_SIZE)]
+    count('lean_search_queries', len(texts))
+    session = make_session(workers, headers)
+    limiter = RateLimiter(rate)
+
+    def _search_batch(batch):
         json_data = {
-        'query': [text[:19000] for text in texts[10*i:10*(i+1)]],
-        'num_results': 10,
+        'query': [text[:MAX_QUERY_CHARS] for text in batch],
+        'num_results': num_results,
         }
-        response = requests.post('https://leansearch.net/search',headers=headers,json=json_data)
-        print(i*10)
-        try:
-            response_jsons_full += response.json()
-        except Exception as e:
-            print(e)
+        with span('lean_search_batch', queries=len(batch)):
+            response = request_with_retry(session, 'POST', LEAN_SEARCH_URL, limiter=limiter,
+                                          json=json_data, timeout=LEAN_SEARCH_TIMEOUT)
+        response_jsons = response.json()
+        if len(response_jsons) != len(batch):
+            raise ValueError(f"leansearch returned {len(response_jsons)} results for {len(batch)} queries")
+        return response_jsons
+
+    response_jsons_full = []
+    failed = []
+    with session, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_search_batch, batch) for batch in batches]
+        for i, future in enumerate(futures):
+            try:
+                response_jsons = future.result()
+            except Exception as e:
+                print(f"Batch starting at row {i*LEAN_SEARCH_BATCH_SIZE} failed: {e}")
+                failed.append(i*LEAN_SEARCH_BATCH_SIZE)
+                response_jsons = [None] * len(batches[i])
+            response_jsons_full += response_jsons
+    if failed:
+        # never assign a shorter column, which would shift results against the dataframe rows
+        raise PartialRetrievalError(f"leansearch failed for {len(failed)} batches starting at rows {failed}",
+                                    {position: response for position, response in enumerate(response_jsons_full)
+                                     if response is not None})
     df[new_col_name] = response_jsons_full
     return df
 
+def _mathlib_declaration_documents():
+    # returns (texts, results, fingerprint) for every named declaration in mathlib4; results follow the
+    # lean_search format and the fingerprint identifies the declaration list an index was built from
+    if MATHLIB4_LOC not in _MATHLIB_DECLARATIONS:
+        texts, results = [], []
+        for path, result in scan_mathlib().items():
+            module_name = os.path.relpath(path[:-len('.lean')], MATHLIB4_LOC).split(os.path.sep)
+            for declaration in result['declarations']:
+                if not declaration['name']:
+                    continue
+                texts.append(" ".join([declaration['name'], declaration['signature'], declaration['doc'],
+                                       " ".join(module_name)]))
+                results.append({'result': {'module_name': module_name, 'signature': declaration['signature'],
+                                           'name': declaration['name'].split('.'), 'kind': declaration['kind'],
+                                           'docstring': declaration['doc']}})
+        fingerprint = hashlib.sha1(json.dumps(results).encode('utf-8')).hexdigest()
+        _MATHLIB_DECLARATIONS[MATHLIB4_LOC] = texts, results, fingerprint
+    return _MATHLIB_DECLARATIONS[MATHLIB4_LOC]
+
+
+@traced()
+def load_bm25_index(index_path=BM25_INDEX_PATH):
+    # builds the index once per mathlib4 state and reuses the stored one as long as the declarations match
+    if index_path not in _LOCAL_INDEXES:
+        texts, results, fingerprint = _mathlib_declaration_documents()
+        index = None
+        if os.path.exists(index_path + '.npz'):
+            index = BM25Index.load(index_path)
+            if index.fingerprint != fingerprint:
+                index = None
+        if index is None:
+            index = BM25Index.build(texts, results, fingerprint)
+            index.save(index_path)
+        _LOCAL_INDEXES[index_path] = index
+    return _LOCAL_INDEXES[index_path]
+
+
+@traced()
+def load_code_index(index_path=CODE_INDEX_PATH):
+    # line and declaration byte offsets of all scanned mathlib4 files, rebuilt when any of them changes
+    if index_path not in _LOCAL_INDEXES:
+        scans = scan_mathlib()
+        paths = [os.path.relpath(path, MATHLIB4_LOC) for path in scans]
+        stats = [os.stat(path) for path in scans]
+        fingerprint = hashlib.sha1(json.dumps([SCAN_VERSION] + [[path, stat.st_mtime_ns, stat.st_size]
+                                               for path, stat in zip(paths, stats)]).encode('utf-8')).hexdigest()
+        index = None
+        if os.path.exists(index_path + '.json'):
+            index = CodeIndex.load(index_path, MATHLIB4_LOC)
+            if index.meta.get('fingerprint') != fingerprint:
+                index = None
+        if index is None:
+            declarations = {}
+            for path, result in zip(paths, scans.values()):
+                module_name = path[:-len('.lean')].split(os.path.sep)
+                for declaration in result['declarations']:
+                    if declaration['name']:
+                        declarations.setdefault(CodeIndex.key(module_name, declaration['name']),
+                                                (path, declaration['line_start'], declaration['line_end']))
+            index = CodeIndex.build(MATHLIB4_LOC, paths, declarations, index_path, {'fingerprint': fingerprint})
+        _LOCAL_INDEXES[index_path] = index
+    return _LOCAL_INDEXES[index_path]
+
+
+def sentence_transformer_encoder(model_name=DENSE_MODEL):
+    # CPU-only encoder; sentence-transformers is an optional dependency needed for dense_search only
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        raise ImportError("dense_search needs sentence-transformers: python -m pip install sentence-transformers")
+    model = SentenceTransformer(model_name, device='cpu')
+    return lambda texts: model.encode(texts, batch_size=64, convert_to_numpy=True)
+
+
+@traced()
+def load_dense_index(index_path=DENSE_INDEX_PATH, encode=None, model_name=DENSE_MODEL, dtype=DENSE_DTYPE):
+    # returns (index, encode); the declarations are embedded once per mathlib4 state, model and dtype
+    if index_path not in _LOCAL_INDEXES:
+        texts, results, fingerprint = _mathlib_declaration_documents()
+        encode = encode or sentence_transformer_encoder(model_name)
+        index = None
+        if os.path.exists(index_path + '.json'):
+            index = DenseIndex.load(index_path)
+            if (index.meta.get('fingerprint') != fingerprint or index.meta.get('model') != model_name
+                    or index.meta.get('dtype') != dtype):
+                index = None
+        if index is None:
+            index = DenseIndex.build(texts, encode, index_path, {'fingerprint': fingerprint, 'model': model_name},
+                                     dtype=dtype)
+        index.results = results
+        _LOCAL_INDEXES[index_path] = index, encode
+    return _LOCAL_INDEXES[index_path]
+
+
+@traced()
+def bm25_search(df, column, new_col_name='bm25_search', num_results=10):
+    # offline retriever over mathlib4 declarations (name, signature, docstring, module path)
+    index = load_bm25_index()
+    df[new_col_name] = [index.search(text[:MAX_QUERY_CHARS], num_results) for text in df[column].to_list()]
+    return df
+
+
+@traced()
+def dense_search(df, column, new_col_name='dense_search', num_results=10, batch_size=256):
+    # offline semantic retriever: queries are embedded in batches and scored against the memory-mapped
+    # declaration embeddings with one matrix product per batch
+    index, encode = load_dense_index()
+    texts = [text[:MAX_QUERY_CHARS] for text in df[column].to_list()]
+    response_jsons_full = []
+    for start in range(0, len(texts), batch_size):
+        response_jsons_full += index.search(encode(texts[start:start + batch_size]), num_results)
+    df[new_col_name] = response_jsons_full
+    return df
+
+def normalize_code(code):
+    # fingerprint under which signatures are matched against gold code: spaces and newlines removed
+    return code.replace(' ', '').replace('\n', '')
+
 def match_cond_code_and_module(lean_search_item, df_row):
     lean_search_result = lean_search_item['result']
     if not lean_search_result['module_name'] in df_row['module_name']:
@@ -291,8 +841,7 @@ def match_cond_code_and_module(lean_search_item, df_row):
         i = df_row['module_name'].index(lean_search_result['module_name'])
 
     if lean_search_result['signature']:
-        return [i] if (lean_search_result['signature'].replace(' ', '').replace('\n', '')
-                in df_row.code[i].replace(' ', '').replace('\n', '')) else []
+        return [i] if normalize_code(lean_search_result['signature']) in normalize_code(df_row.code[i]) else []
     else:
         return [i] if (lean_search_result['name'][-1]
                        in df_row['formal_statement'][i]) else []
@@ -316,7 +865,188 @@ def recalls(lean_search_results, df_row, match_condition,n):
             recalled += match_cond_code_and_module(lean_search_item, df_row)
     return len(set(recalled))/len(df_row['module_name'])
 
-def df_evaluate(df, text_column, output_suffix='', avail_columns=['module_name'], retriever='lean_search'):
+# a gold code is scanned once for all its retrieved signatures only if it is long and retrieved with many
+# distinct signatures; otherwise one substring test per signature is faster
+AHOCORASICK_MIN_SIGNATURES = 16
+AHOCORASICK_MIN_CODE_LENGTH = 8192
+
+def _found_signatures(signatures, code):
+    # the normalized signatures occurring in the normalized gold code, found in one Aho-Corasick scan of it
+    automaton = ahocorasick.Automaton()
+    for signature in signatures:
+        automaton.add_word(signature, signature)
+    automaton.make_automaton()
+    return {signature for _, signature in automaton.iter(code)}
+
+@traced()
+def hit_matrix(df, results_column, match_condition, max_hits=None):
+    # vectorized counterpart of recalls(): returns an int8 matrix of shape (rows, hits) with a 1 where the
+    # hit matches a gold item (under match_cond_module or match_cond_code_and_module) that no earlier hit
+    # of the same row matched, so that recall@n is the row sum of the first n columns over the gold count.
+    # Module names are interned once per dataframe; gold code and retrieved signatures are normalized once
+    # per dataframe. If pyahocorasick is installed, long gold codes retrieved with many distinct signatures
+    # are checked against all of them in one scan.
+    results_lists = df[results_column].to_list()
+    if max_hits is None:
+        max_hits = max([len(results) for results in results_lists], default=0)
+    hits = np.zeros((len(df), max_hits), dtype=np.int8)
+    count('rows_scored', len(df))
+    module_ids = {}
+    codes = df['code'].to_list() if match_condition == 'code' else None
+    formal_statements = df['formal_statement'].to_list() if match_condition == 'code' else None
+    normalized_codes = {}
+    normalized_signatures = {}
+    for row, (results, module_names) in enumerate(zip(results_lists, df['module_name'].to_list())):
+        first_index = {}
+        for i, module_name in enumerate(module_names):
+            first_index.setdefault(module_ids.setdefault(tuple(module_name), len(module_ids)), i)
+        candidates = []
+        for j, lean_search_item in enumerate(results[:max_hits]):
+            lean_search_result = lean_search_item['result']
+            i = first_index.get(module_ids.get(tuple(lean_search_result['module_name'])))
+            if i is not None:
+                candidates.append((j, i, lean_search_result))
+        found = {}
+        if match_condition == 'code' and ahocorasick is not None:
+            signatures = {}
+            for j, i, lean_search_result in candidates:
+                if lean_search_result['signature']:
+                    signatures.setdefault(i, set()).add(normalize_code(lean_search_result['signature']))
+            for i, gold_signatures in signatures.items():
+                gold_signatures.discard('')
+                if (len(gold_signatures) >= AHOCORASICK_MIN_SIGNATURES
+                        and len(codes[row][i]) >= AHOCORASICK_MIN_CODE_LENGTH):
+                    if codes[row][i] not in normalized_codes:
+                        normalized_codes[codes[row][i]] = normalize_code(codes[row][i])
+                    found[i] = _found_signatures(gold_signatures, normalized_codes[codes[row][i]])
+                    count('ahocorasick_scans')
+        recalled = set()
+        for j, i, lean_search_result in candidates:
+            if i in recalled:
+                continue
+            if match_condition == 'code':
+                if lean_search_result['signature']:
+                    signature = lean_search_result['signature']
+                    if signature not in normalized_signatures:
+                        normalized_signatures[signature] = normalize_code(signature)
+                    if i in found:
+                        if normalized_signatures[signature] and normalized_signatures[signature] not in found[i]:
+                            continue
+                    else:
+                        if codes[row][i] not in normalized_codes:
+                            normalized_codes[codes[row][i]] = normalize_code(codes[row][i])
+                        if normalized_signatures[signature] not in normalized_codes[codes[row][i]]:
+                            continue
+                elif lean_search_result['name'][-1] not in formal_statements[row][i]:
+                    continue
+            recalled.add(i)
+            hits[row, j] = 1
+    return hits
+
+
+def recalls_at(hits, n_gold, cutoffs=(1, 5, 10)):
+    # returns dict cutoff -> array of per row recall@cutoff computed from one cumulative sum over the hit matrix
+    cumulative = np.cumsum(hits, axis=1, dtype=np.int32)
+    cumulative = np.concatenate([np.zeros((len(hits), 1), dtype=np.int32), cumulative], axis=1)
+    n_gold = np.asarray(n_gold, dtype=np.float64)
+    return {n: cumulative[:, min(n, hits.shape[1])] / n_gold for n in cutoffs}
+
+
+#### Retrieval cache
+# Retriever outputs are stored per (retriever, truncated query, num_results) in a sqlite file, so that
+# re-running the evaluation only queries the retriever for new texts. Entries are evicted least recently
+# used first once the cache holds more than RETRIEVAL_CACHE_MAX_ENTRIES results. With
+# RETRIEVAL_REPLAY_ONLY set, uncached queries raise instead of calling the retriever. Retrievers in
+# UNCACHED_RETRIEVERS bypass the cache.
+def call_retriever(retriever_func, df, column, new_col_name, num_results=10):
+    # retrievers written before num_results was passed on take (df, column, new_col_name) only and
+    # return their default number of results
+    parameters = inspect.signature(retriever_func).parameters
+    if 'num_results' in parameters or any(p.kind == p.VAR_KEYWORD for p in parameters.values()):
+        return retriever_func(df, column, new_col_name, num_results=num_results)
+    return retriever_func(df, column, new_col_name)
+
+
+def _retrieval_key(retriever, text, num_results):
+    return hashlib.sha256(json.dumps([retriever, text[:MAX_QUERY_CHARS], num_results]).encode('utf-8')).hexdigest()
+
+
+def _open_retrieval_cache(cache_path):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    con = sqlite3.connect(cache_path)
+    con.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, retriever TEXT, '
+                'num_results INTEGER, response BLOB, accessed REAL)')
+    con.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+    return con
+
+
+def _store_retrievals(con, retriever, num_results, responses, now, max_entries):
+    with con:
+        con.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                        [(key, retriever, num_results, zlib.compress(json.dumps(response).encode('utf-8')), now)
+                         for key, response in responses.items()])
+        (size,) = con.execute('SELECT COUNT(*) FROM results').fetchone()
+        if size > max_entries:
+            con.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)',
+                        (size - max_entries,))
+
+
+@traced()
+def cached_retrieval(retriever_func, df, column, new_col_name, retriever, num_results=10,
+                     cache_path=None, replay_only=None, max_entries=None):
+    # same contract as the retriever functions, but only rows with uncached queries are passed on
+    cache_path = RETRIEVAL_CACHE_PATH if cache_path is None else cache_path
+    replay_only = RETRIEVAL_REPLAY_ONLY if replay_only is None else replay_only
+    max_entries = RETRIEVAL_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+
+    keys = [_retrieval_key(retriever, text, num_results) for text in df[column].to_list()]
+    con = _open_retrieval_cache(cache_path)
+    cached = {}
+    unique_keys = list(dict.fromkeys(keys))
+    for i in range(0, len(unique_keys), 500):
+        chunk = unique_keys[i:i + 500]
+        cached.update(con.execute(f"SELECT key, response FROM results WHERE key IN ({','.join('?' * len(chunk))})",
+                                  chunk).fetchall())
+    now = time.time()
+    with con:
+        con.executemany('UPDATE results SET accessed = ? WHERE key = ?', [(now, key) for key in cached])
+    cached = {key: json.loads(zlib.decompress(response)) for key, response in cached.items()}
+
+    missing_keys = {}
+    for position, key in enumerate(keys):
+        if key not in cached and key not in missing_keys:
+            missing_keys[key] = position
+    count('retrieval_cache_hits', sum(key in cached for key in keys))
+    count('retrieval_cache_misses', len(missing_keys))
+    print(f"{retriever}: {sum(key in cached for key in keys)} of {len(keys)} queries served from cache")
+    if missing_keys:
+        if replay_only:
+            con.close()
+            raise KeyError(f"{len(missing_keys)} queries for {retriever} are not cached and replay only mode is set")
+        missing_df = df.iloc[list(missing_keys.values())].copy()
+        try:
+            missing_df = call_retriever(retriever_func, missing_df, column, new_col_name, num_results=num_results)
+        except PartialRetrievalError as e:
+            # keep what was answered, so that the next run only sends the failed queries again
+            missing = list(missing_keys)
+            _store_retrievals(con, retriever, num_results,
+                              {missing[position]: response for position, response in e.results.items()},
+                              now, max_entries)
+            con.close()
+            raise
+        responses = dict(zip(missing_keys, missing_df[new_col_name].to_list()))
+        _store_retrievals(con, retriever, num_results, responses, now, max_entries)
+        cached.update(responses)
+    con.close()
+    df[new_col_name] = [cached[key] for key in keys]
+    return df
+
+
+@traced()
+def df_evaluate(df, text_column, output_suffix='', avail_columns=['module_name'], retriever='lean_search',
+                num_results=10, use_cache=True, cutoffs=(1, 5, 10), report_name=None):
+    # with report_name set, MRR, MAP, nDCG@k, P@k and R@k with bootstrap intervals are written to
+    # REPORT_DIR/<report_name>_<retriever>.json and per query to the matching .parquet file
     # if retriever=='lean_search':
     #     df = lean_search(df, text_column + output_suffix, 'lean_search' + output_suffix)
     # else:
@@ -324,34 +1054,40 @@ def df_evaluate(df, text_column, output_suffix='', avail_columns=['module_name']
     #this function must behave the same way that lean_search does!
     #that is, given a dataframe as input with specified input column, it appends a column named retriever + output_suffix.
     #Entries in this column MUST be of the form list["result":{"module_name":list[],"signature":str,"name":list[],...},...]
-    df = retriever_func(df, text_column + output_suffix, retriever + output_suffix)
+    if use_cache and retriever not in UNCACHED_RETRIEVERS:
+        df = cached_retrieval(retriever_func, df, text_column + output_suffix, retriever + output_suffix,
+                              retriever, num_results=num_results)
+    else:
+        df = call_retriever(retriever_func, df, text_column + output_suffix, retriever + output_suffix,
+                            num_results=num_results)
 
 
     def _get_scores(df,output_suffix,avail_columns):
+        n_gold = df['module_name'].map(len).to_numpy() if 'module_name' in avail_columns else None
+        metrics_by_condition = {}
 
         if 'module_name' in avail_columns:
-            match_condition='module'
-            df['module_match_R@1'+output_suffix] = df.apply(lambda x:
-                                recalls(x['lean_search'+output_suffix], x, match_condition,1), axis=1)
-            df['module_match_R@5'+output_suffix] = df.apply(lambda x:
-                                recalls(x['lean_search'+output_suffix], x, match_condition,5), axis=1)
-            df['module_match_R@10'+output_suffix] = df.apply(lambda x:
-                                recalls(x['lean_search'+output_suffix], x, match_condition,10), axis=1)
-            print('module_match_R@1: ',df['module_match_R@1'+output_suffix].mean())
-            print('module_match_R@5: ', df['module_match_R@5'+output_suffix].mean())
-            print('module_match_R@10: ', df['module_match_R@10'+output_suffix].mean())
+            hits = hit_matrix(df, retriever+output_suffix, 'module')
+            for n, recall in recalls_at(hits, n_gold, cutoffs).items():
+                df[f'module_match_R@{n}'+output_suffix] = recall
+            for n in cutoffs:
+                print(f'module_match_R@{n}: ',df[f'module_match_R@{n}'+output_suffix].mean())
+            metrics_by_condition['module_match'] = per_query_metrics(hits, n_gold, cutoffs)
 
         if 'code' in avail_columns and 'module_name' in avail_columns:
-            match_condition='code'
-            df['full_match_R@1: '+output_suffix] = df.apply(lambda x:
-                                recalls(x['lean_search'+output_suffix], x, match_condition,1), axis=1)
-            df['full_match_R@5: '+output_suffix] = df.apply(lambda x:
-                                recalls(x['lean_search'+output_suffix], x, match_condition,5), axis=1)
-            df['full_match_R@10: '+output_suffix] = df.apply(lambda x:
-                                recalls(x['lean_search'+output_suffix], x, match_condition,10), axis=1)
-            print(df['full_match_R@1: '+output_suffix].mean())
-            print(df['full_match_R@5: '+output_suffix].mean())
-            print(df['full_match_R@10: '+output_suffix].mean())
+            hits = hit_matrix(df, retriever+output_suffix, 'code')
+            for n, recall in recalls_at(hits, n_gold, cutoffs).items():
+                df[f'full_match_R@{n}: '+output_suffix] = recall
+            for n in cutoffs:
+                print(df[f'full_match_R@{n}: '+output_suffix].mean())
+            metrics_by_condition['full_match'] = per_query_metrics(hits, n_gold, cutoffs)
+
+        if report_name and metrics_by_condition:
+            report_path = os.path.join(REPORT_DIR, f'{report_name}_{retriever}{output_suffix}')
+            write_report(report_path, df[text_column + output_suffix].to_list(), metrics_by_condition,
+                         meta={'dataset': report_name, 'retriever': retriever, 'text_column': text_column,
+                               'num_results': num_results})
+            print(f"Report written to {report_path}.json")
 
         return df
 
@@ -361,84 +1097,92 @@ def df_evaluate(df, text_column, output_suffix='', avail_columns=['module_name']
 
     return df
 
-def evaluate_zbmath_no_books(test=False,retriever='lean_search'):
-    nonbooks_w_zbl = match_bibrefs_to_bib_file()
-
-    all_kinds_ids = []
-    for key in nonbooks_w_zbl.keys():
-        all_kinds_ids += nonbooks_w_zbl[key]
-
-    nonbooks_w_zbl_inv = {id:[] for id in all_kinds_ids}
-    for key in nonbooks_w_zbl:
-        for id in nonbooks_w_zbl[key]:
-            nonbooks_w_zbl_inv[id].append(key)
-
-    zbl_refs_df = pd.DataFrame([{"zbl_id":key, "module_name":[val[:val.index('.lean')].replace(
-        os.path.join(HOME,'mathlib4'),'').split(os.path.sep)[1:] for val in value]}
-                                for key, value in nonbooks_w_zbl_inv.items()])
-
-
-    if not os.path.exists(os.path.join(HOME,'leandocs.csv')):
+def build_zbmath_dataset(cache_path=ZBMATH_DATASET_PATH):
+    # one frame for both zbmath evaluations, built in one pass over the bib references: per cited zbl_id its
+    # abstract from leandocs.csv (the shortest one if there are several), the modules citing it (module_name)
+    # and the modules citing it through non-book bib entries (module_name_no_books). The joined frame is cached
+    # in cache_path and rebuilt when the references or leandocs.csv change.
+    zbl_references = bib_zbl_references()
+    leandocs_path = resolve_dataset(os.path.join(HOME,'leandocs.csv'))
+    if not os.path.exists(leandocs_path):
       print("Need to build 'leandocs.csv' first!")
-    #collection of abstracts. Can be obtained by querying zbmath.org
-    zb_docs_df = pd.read_csv(os.path.join(HOME,'leandocs.csv'),
-                              encoding='utf-8',delimiter=',',dtype=str)
+    fingerprint = content_fingerprint(leandocs_path, ZBMATH_DATASET_VERSION, MATHLIB4_LOC, zbl_references)
+    zbmath_df = read_cached(cache_path, fingerprint)
+    if zbmath_df is not None:
+        return zbmath_df
+
+    modules = {}
+    for path, entries in zbl_references.items():
+        module_name = os.path.relpath(path[:path.index('.lean')], MATHLIB4_LOC).split(os.path.sep)
+        for zbl_id, entrytype in entries:
+            all_modules, non_book_modules = modules.setdefault(zbl_id, ([], []))
+            all_modules.append(module_name)
+            if entrytype != 'book':
+                non_book_modules.append(module_name)
+    zbl_refs_df = pd.DataFrame([{'zbl_id': zbl_id, 'module_name': all_modules, 'module_name_no_books': non_book_modules}
+                                for zbl_id, (all_modules, non_book_modules) in modules.items()],
+                               columns=['zbl_id', 'module_name', 'module_name_no_books'])
 
-    zbl_docs_df_test = zbl_refs_df.join(zb_docs_df.set_index('zbl_id'), on='zbl_id', how='inner')
-    zbl_docs_df_test = zbl_docs_df_test.dropna(subset='texts',axis='rows')
+    #collection of abstracts. Can be obtained by querying zbmath.org
+    zb_docs_df = read_dataset(leandocs_path, encoding='utf-8', dtype=str).dropna(subset='texts')
+    zb_docs_df = zb_docs_df.iloc[zb_docs_df['texts'].str.len().argsort(kind='stable')]
+    zb_docs_df = zb_docs_df.drop_duplicates(subset='zbl_id', keep='first')
+    zbmath_df = zbl_refs_df.join(zb_docs_df.set_index('zbl_id'), on='zbl_id', how='inner').reset_index(drop=True)
+
+    write_cached(zbmath_df, cache_path, fingerprint)
+    return zbmath_df
+
+def zbmath_view(zbmath_df, books_ok=False):
+    # rows of build_zbmath_dataset cited by a module (through a non-book entry unless books_ok)
+    module_column = 'module_name' if books_ok else 'module_name_no_books'
+    view = zbmath_df[zbmath_df[module_column].map(len) > 0]
+    view = view.assign(module_name=view[module_column]).drop(columns='module_name_no_books')
+    return view.reset_index(drop=True)
+
+@traced()
+def evaluate_zbmath_no_books(test=False,retriever='lean_search'):
+    zbl_docs_df_test = zbmath_view(build_zbmath_dataset(), books_ok=False)
 
     ## test
     if test:
-        df_evaluate(zbl_docs_df_test,'texts',retriever=retriever)
+        df_evaluate(zbl_docs_df_test,'texts',retriever=retriever,report_name='zbmath_no_books')
 
     return zbl_docs_df_test
 
+@traced()
 def evaluate_zbmath_with_books(test=False,retriever='lean_search'):
-    all_w_zbl = match_bibrefs_to_bib_file(books_ok=True)
-
-    all_kinds_ids = []
-    for key in all_w_zbl.keys():
-        all_kinds_ids += all_w_zbl[key]
-
-    all_w_zbl_inv = {id:[] for id in all_kinds_ids}
-    for key in all_w_zbl:
-        for id in all_w_zbl[key]:
-            all_w_zbl_inv[id].append(key)
-
-    zbl_refs_df_full = pd.DataFrame([{"zbl_id":key, "module_name":[val[:val.index('.lean')].replace(
-        os.path.join(HOME,'mathlib4/'),'').split(os.path.sep)[1:] for val in value]}
-                                for key, value in all_w_zbl_inv.items()])
-    zb_docs_df_full = pd.read_csv(os.path.join(HOME,'leandocs.csv'), encoding='utf-8',names=['zbl_id','texts'],dtype=str)
-    zb_docs_df_full = zb_docs_df_full.sort_values(by='texts',key = lambda x:x.str.len())
-    zb_docs_df_full = zb_docs_df_full.sort_values(by='zbl_id')
-    zb_docs_df_full = zb_docs_df_full.drop_duplicates(subset='zbl_id',keep='first')
-    zbl_refs_df_full = zbl_refs_df_full.join(zb_docs_df_full.set_index('zbl_id'),on='zbl_id',how='inner')
+    zbl_refs_df_full_test = zbmath_view(build_zbmath_dataset(), books_ok=True)
 
     ##test
-    zbl_refs_df_full_test = zbl_refs_df_full.dropna(axis='rows',subset='texts')
     if test:
-        df_evaluate(zbl_refs_df_full_test,'texts',retriever=retriever)
+        df_evaluate(zbl_refs_df_full_test,'texts',retriever=retriever,report_name='zbmath_with_books')
 
     return zbl_refs_df_full_test
 
 
-def evaluate_stacks_project(test=False,retriever='lean_search'):
+@traced()
+def evaluate_stacks_project(test=False,retriever='lean_search',augment_depth=AUGMENT_DEPTH,
+                            augment_max_tokens=AUGMENT_MAX_TOKENS):
     stacks_dict = extract_stacks_attribute_refs()
     stacks_formal_df = pd.DataFrame(stacks_dict)
 
-    #run "python stacks.py" in order to create stacks_project.csv
-    stacks_texts_full = pd.read_csv(os.path.join(HOME,'stacks_project.csv'),encoding='utf-8')
-    stacks_texts_full['content'] = stacks_texts_full['content'].apply(lambda x: BeautifulSoup(x,features="lxml").text[2:-1])
-    stacks_texts_full['statement'] = stacks_texts_full.content.apply(lambda text:
-                                            text[:text.index('Proof.')].strip() if 'Proof.' in text else text.strip())
-    stacks_texts_full['proof'] = stacks_texts_full.content.apply(lambda text:
-                        text[text.index('Proof.'):] .strip() if 'Proof.' in text else "")
+    #run "python stacks.py" in order to create stacks_project.csv (and stacks_project.parquet, read if present)
+    stacks_texts_full = load_stacks_texts(resolve_dataset(os.path.join(HOME,'stacks_project.csv')))
     stacks_formal_informal = stacks_formal_df.join(stacks_texts_full.set_index('tag'),on='stacks tag').dropna(subset=['content'],axis='rows')
     stacks_formal_informal['formal_proof'] = stacks_formal_informal.code.apply(lambda x:":=".join(x.split(':=')[1:]) if ':=' in x else '')
     stacks_formal_informal['formal_statement'] = stacks_formal_informal.code.apply(lambda x:x.split(':=')[0] if ':=' in x else x)
-    stacks_formal_informal['augmented_proof'] = stacks_formal_informal.proof.apply(lambda x:augment_informal_proof(x,stacks_texts_full))
-    stacks_formal_informal['augmented_statement'] = stacks_formal_informal.statement.apply(lambda x:x[:25]+augment_informal_proof(x[25:],stacks_texts_full))
-    stacks_formal_informal['augmented_content'] = stacks_formal_informal.content.apply(lambda x:x[:25]+augment_informal_proof(x[25:],stacks_texts_full))
+    # augment_depth=0 leaves the texts as they are, 1 inlines the statements cited directly, higher depths
+    # also inline what those cite
+    if augment_depth < 0:
+        raise ValueError(f"augment_depth must be at least 0, got {augment_depth}")
+    if augment_depth:
+        statements = expand_statements(reference_statements(stacks_texts_full), augment_depth - 1, augment_max_tokens)
+        augment = lambda x:augment_informal_proof(x,statements)
+    else:
+        augment = lambda x:x
+    stacks_formal_informal['augmented_proof'] = stacks_formal_informal.proof.apply(augment)
+    stacks_formal_informal['augmented_statement'] = stacks_formal_informal.statement.apply(lambda x:x[:25]+augment(x[25:]))
+    stacks_formal_informal['augmented_content'] = stacks_formal_informal.content.apply(lambda x:x[:25]+augment(x[25:]))
     stacks_formal_informal['module_name'] = stacks_formal_informal['url'].apply(lambda x:x[:x.index('.lean')].replace(mathlib_url,'').split('/')[1:])
 
 
@@ -449,7 +1193,8 @@ def evaluate_stacks_project(test=False,retriever='lean_search'):
          'code':lambda x:x.tolist()},axis=1).reset_index()
     if test:
         print("Input: Augmented Statement")
-        df_evaluate(stacks_formal_informal_eval_statement,'augmented_statement',avail_columns=['module_name','code'])
+        df_evaluate(stacks_formal_informal_eval_statement,'augmented_statement',avail_columns=['module_name','code'],
+                    retriever=retriever, report_name='stacks_statement')
 
     stacks_formal_informal_eval_proof = stacks_formal_informal.groupby('augmented_proof').agg(
         {'module_name':lambda x:x.tolist(),
@@ -460,7 +1205,8 @@ def evaluate_stacks_project(test=False,retriever='lean_search'):
         df_evaluate(stacks_formal_informal_eval_proof,
                     'augmented_proof',
                     avail_columns=['module_name','code'],
-                    retriever=retriever)
+                    retriever=retriever,
+                    report_name='stacks_proof')
 
     stacks_formal_informal_eval_content = stacks_formal_informal.groupby('augmented_content').agg(
         {'module_name':lambda x:x.tolist(),
@@ -468,10 +1214,12 @@ def evaluate_stacks_project(test=False,retriever='lean_search'):
          'code':lambda x:x.tolist()},axis=1).reset_index()
     if test:
         print("Input: Augmented Statement + Augmented Proof")
-        df_evaluate(stacks_formal_informal_eval_content,'augmented_content',avail_columns=['module_name','code'])
+        df_evaluate(stacks_formal_informal_eval_content,'augmented_content',avail_columns=['module_name','code'],
+                    retriever=retriever, report_name='stacks_content')
 
     return stacks_formal_informal_eval_statement, stacks_formal_informal_eval_proof, stacks_formal_informal_eval_content
 
+@traced()
 def evaluate_wikipedia_references(test=False,retriever='lean_search'):
     files_w_refs = extract_references()
     files_w_wikilinks = {key:[link for link in files_w_refs[key]['wikilinks'] if 'wikipedia' in link] for key in files_w_refs.keys()}
@@ -484,9 +1232,10 @@ def evaluate_wikipedia_references(test=False,retriever='lean_search'):
     wiki_df['texts'] = get_theorems_bulk(wiki_df.title.to_list())
     wiki_df = wiki_df.groupby('texts').agg({'module_name':lambda x:x.tolist()}).reset_index()
     if test:
-        df_evaluate(wiki_df, 'texts',retriever=retriever)
+        df_evaluate(wiki_df, 'texts',retriever=retriever,report_name='wikipedia')
     return wiki_df
 
+@traced()
 def evaluate_1000_theorems(test=False,retriever='lean_search'):
     def _parse_1000_theorems_page():
         response = requests.get('https://leanprover-community.github.io/1000.html')
@@ -502,6 +1251,8 @@ def evaluate_1000_theorems(test=False,retriever='lean_search'):
                                                                       split[i].text == 'source'] for split in
                               soup_split_by_headers}
         theorems_code_sources = {}
+        # line ranges are sliced from the memory-mapped sources through the code index
+        code_index = load_code_index()
         for qid, links in soup_split_sources.items():
             theorems_code_sources[qid] = {}
             for link in links:
@@ -509,15 +1260,14 @@ def evaluate_1000_theorems(test=False,retriever='lean_search'):
                     continue
                 uri = link[link.index('Mathlib/'):link.index('#')]
                 line_nos = re.findall(r'\d+', link[link.index('#'):])
+                if uri.replace('/', os.path.sep) not in code_index.file_ids:
+                    print(link)
+                    continue
                 try:
-                    with open(os.path.join(HOME, 'mathlib4', uri), encoding='utf-8') as fh:
-                        lines = fh.readlines()
-                        try:
-                            theorems_code_sources[qid][link] = "".join(lines[int(line_nos[0]) - 1:int(line_nos[1])])
-                        except:
-                            print(line_nos)
+                    theorems_code_sources[qid][link] = code_index.lines(uri.replace('/', os.path.sep),
+                                                                        int(line_nos[0]), int(line_nos[1]))
                 except:
-                    print(link)
+                    print(line_nos)
         return theorems_code_sources
     #obtained from https://github.com/leanprover-community/mathlib4/blob/master/docs/1000.yaml
     with open(os.path.join(HOME,"1000.yaml"),encoding='utf-8') as stream:
@@ -547,7 +1297,8 @@ def evaluate_1000_theorems(test=False,retriever='lean_search'):
     ###only for evaluation
     formal_proofs_df_test = formal_proofs_df[formal_proofs_df['code'].map(len)>0]
     if test:
-        df_evaluate(formal_proofs_df_test, 'texts', avail_columns=['code','module_name'],retriever=retriever)
+        df_evaluate(formal_proofs_df_test, 'texts', avail_columns=['code','module_name'],retriever=retriever,
+                    report_name='1000_theorems')
 
     return formal_proofs_df_test
 
@@ -571,7 +1322,32 @@ if __name__=="__main__":
         help="Retriever value argument (default: %(default)s)"
     )
 
+    parser.add_argument(
+        "--replay-only",
+        action="store_true",
+        help="Only use cached retrieval results, fail on queries that are not cached"
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs='+',
+        default=[],
+        metavar="SPAN",
+        help="Profile these spans (e.g. evaluate_stacks_project scan_mathlib, '*' for every evaluator) into reports/profiles"
+    )
+
+    parser.add_argument(
+        "--profiler",
+        choices=['cprofile', 'pyinstrument'],
+        default='cprofile',
+        help="Profiler used for --profile (default: %(default)s)"
+    )
+
     args = parser.parse_args()
+    RETRIEVAL_REPLAY_ONLY = args.replay_only
+    instrumentation.PROFILE_SPANS = set(args.profile)
+    instrumentation.PROFILER = args.profiler
+    instrumentation.PROFILE_DIR = os.path.join(REPORT_DIR, 'profiles')
 
 
     # Example of storing them in variables for later use:
@@ -606,4 +1382,11 @@ if __name__=="__main__":
     print("Evaluating Stacks Project")
     print(evaluate_stacks_project(test,retriever))
 
+    # spans and counters of the whole run: reports/run_<retriever>.json and .trace.json (Chrome trace format)
+    run_report = instrumentation.write_report(os.path.join(REPORT_DIR, f'run_{retriever}'),
+                                              meta={'retriever': retriever, 'test': test})
+    for name, stats in sorted(run_report['spans'].items(), key=lambda item: -item[1]['total_s']):
+        print(f"{name}: {stats['total_s']:.1f}s in {stats['count']} calls")
+    print(run_report['counters'])
+
 
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Ranking metrics over the hit matrices built by mathlib_refs.hit_matrix: hits[q, j] is 1 iff the j-th
+# retrieved item of query q matches a gold item no earlier item matched, n_gold[q] is the number of gold
+# items. All metrics are computed for all queries at once; reports are written as a JSON summary plus a
+# Parquet table of per-query values, and paired bootstrap confidence intervals compare two such reports.
+
+
+def per_query_metrics(hits, n_gold, cutoffs=(1, 5, 10)):
+    # returns dict metric name -> array of per-query values
+    hits = np.asarray(hits, dtype=np.float64)
+    n_gold = np.asarray(n_gold, dtype=np.float64)
+    n_queries, n_hits = hits.shape
+    ranks = np.arange(1, n_hits + 1, dtype=np.float64)
+    cumulative = np.cumsum(hits, axis=1)
+    discounts = 1 / np.log2(ranks + 1)
+    ideal = np.concatenate([[0], np.cumsum(discounts)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # argmax is undefined without columns, i.e. when no query got a single result
+        first = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, np.inf) if n_hits else np.full(n_queries, np.inf)
+        metrics = {'MRR': 1 / first,
+                   'MAP': (hits * cumulative / ranks).sum(axis=1) / n_gold}
+        for k in cutoffs:
+            k_hits = min(k, n_hits)
+            recalled = cumulative[:, k_hits - 1] if k_hits else np.zeros(n_queries)
+            metrics[f'R@{k}'] = recalled / n_gold
+            metrics[f'P@{k}'] = recalled / k
+            idcg = ideal[np.minimum(n_gold, k).astype(int).clip(max=n_hits)]
+            metrics[f'nDCG@{k}'] = (hits[:, :k_hits] * discounts[:k_hits]).sum(axis=1) / idcg
+    return {name: np.nan_to_num(values, nan=0.0, posinf=0.0) for name, values in metrics.items()}
+
+
+def bootstrap_means(values, n_resamples=10000, seed=0, chunk_size=256):
+    # values: (n_queries, n_metrics); returns (n_resamples, n_metrics) means over resampled query sets.
+    # Resamples are drawn as multinomial counts, so every chunk is a single matrix product. Without queries
+    # every mean is NaN.
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if not n:
+        return np.full((n_resamples, values.shape[1]), np.nan)
+    rng = np.random.default_rng(seed)
+    means = []
+    for start in range(0, n_resamples, chunk_size):
+        counts = rng.multinomial(n, np.full(n, 1 / n), size=min(chunk_size, n_resamples - start))
+        means.append(counts @ values / n)
+    return np.concatenate(means)
+
+
+def summarize(per_query, n_resamples=1000, alpha=0.05, seed=0):
+    # mean and bootstrap percentile interval of every metric (all NaN without queries)
+    names = list(per_query)
+    values = np.column_stack([per_query[name] for name in names])
+    means = bootstrap_means(values, n_resamples, seed)
+    low, high = np.quantile(means, [alpha / 2, 1 - alpha / 2], axis=0)
+    return {name: {'mean': float(values[:, i].mean()) if len(values) else np.nan, 'ci_low': float(low[i]), 'ci_high': float(high[i])}
+            for i, name in enumerate(names)}
+
+
+def paired_bootstrap(per_query_a, per_query_b, n_resamples=10000, alpha=0.05, seed=0):
+    # per_query_a/b: aligned per-query metrics of two retrievers on the same queries. Returns for every
+    # shared metric the mean difference (a - b), its bootstrap interval and the share of resamples in
+    # which a does not beat b (one sided p-value).
+    names = [name for name in per_query_a if name in per_query_b]
+    differences = np.column_stack([np.asarray(per_query_a[name]) - np.asarray(per_query_b[name]) for name in names])
+    means = bootstrap_means(differences, n_resamples, seed)
+    low, high = np.quantile(means, [alpha / 2, 1 - alpha / 2], axis=0)
+    p_values = (means <= 0).mean(axis=0) if len(differences) else np.full(len(names), np.nan)
+    return {name: {'difference': float(differences[:, i].mean()) if len(differences) else np.nan, 'ci_low': float(low[i]),
+                   'ci_high': float(high[i]), 'p_value': float(p_values[i])}
+            for i, name in enumerate(names)}
+
+
+def write_report(report_path, queries, metrics_by_condition, meta=None, n_resamples=1000):
+    # report_path without extension; writes report_path.json (summary) and report_path.parquet (per query)
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    per_query_df = pd.DataFrame({'query': list(queries)})
+    summary = {}
+    for condition, per_query in metrics_by_condition.items():
+        summary[condition] = summarize(per_query, n_resamples)
+        for name, values in per_query.items():
+            per_query_df[f'{condition}_{name}'] = values
+    per_query_df.to_parquet(report_path + '.parquet', index=False)
+    with open(report_path + '.json', 'w', encoding='utf-8') as fh:
+        json.dump({'meta': meta or {}, 'n_queries': len(per_query_df), 'metrics': summary}, fh, indent=2)
+    return summary
+
+
+def compare_reports(report_path_a, report_path_b, n_resamples=10000, alpha=0.05):
+    # paired bootstrap between two reports of the same dataset, joined on the query text
+    per_query_a = pd.read_parquet(report_path_a + '.parquet')
+    per_query_b = pd.read_parquet(report_path_b + '.parquet')
+    joined = per_query_a.merge(per_query_b, on='query', suffixes=('_a', '_b'))
+    names = [column[:-2] for column in joined.columns if column.endswith('_a')]
+    return paired_bootstrap({name: joined[name + '_a'].to_numpy() for name in names},
+                            {name: joined[name + '_b'].to_numpy() for name in names},
+                            n_resamples, alpha)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Paired bootstrap comparison of two evaluation reports")
+    parser.add_argument("report_a", help="report path without extension, e.g. reports/stacks_proof_lean_search")
+    parser.add_argument("report_b", help="report path without extension, e.g. reports/stacks_proof_bm25_search")
+    parser.add_argument("--resamples", type=int, default=10000)
+    parser.add_argument("--output", help="write the comparison as JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    comparison = compare_reports(args.report_a, args.report_b, args.resamples)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fh:
+            json.dump(comparison, fh, indent=2)
+    else:
+        print(json.dumps(comparison, indent=2))
@@ -1,9 +1,13 @@
 import pandas as pd
+import csv
 import json
-from concurrent.futures import as_completed
-from requests_futures.sessions import FuturesSession
-import requests
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+from http_utils import (HttpMetadataStore, RateLimiter, conditional_get, download_jsonl, load_jsonl_index,
+                        make_session, request_with_retry)
 
 # change if needed.
 HOME = os.getcwd()
@@ -11,7 +15,22 @@ tag_url_prefix = 'https://stacks.math.columbia.edu/data/tag/'
 tag_structure_suffix = '/structure'
 tags_content_suffix = '/content/full'
 parts = ['0ELQ', '0ELP', '0ELV', '0ELT', '0ELN', '0ELW', '0ELS', '0ELR', '0ELU']
-structures = [json.loads(requests.get(tag_url_prefix+prt+tag_structure_suffix).content) for prt in parts]
+# tag contents are appended to CONTENT_JSONL as they arrive ({"tag":..., "content":...} per line), so a
+# restarted download only fetches the tags missing from it
+CONTENT_JSONL = os.path.join(HOME,'stacks_content.jsonl')
+OUTPUT_CSV = os.path.join(HOME,'stacks_project.csv')
+# same table with parents as a typed list column; mathlib_refs reads it instead of the CSV when present
+OUTPUT_PARQUET = os.path.join(HOME,'stacks_project.parquet')
+STACKS_SCHEMA = pa.schema([('tag', pa.string()), ('name', pa.string()), ('reference', pa.string()),
+                           ('type', pa.string()), ('depth', pa.int64()), ('parents', pa.list_(pa.string())),
+                           ('content', pa.string())])
+# ETag/Last-Modified of every downloaded tag; `python -m stacks --refresh` re-requests all tags
+# conditionally and only re-downloads the ones that changed
+HTTP_META_DB = os.path.join(HOME,'cache','stacks_http_meta.sqlite')
+WORKERS = 8  # requests in flight
+RATE = 20  # requests per second
+CHUNK_SIZE = 256  # tags submitted (and rows written to parquet) at a time, bounds the memory held
+
 
 def tree_to_list(tree, depth=0, parents=None):
     result = []
@@ -32,16 +51,89 @@ def tree_to_list(tree, depth=0, parents=None):
 
     return result
 
-structure_list = tree_to_list(structures)
-structure_df = pd.DataFrame(structure_list)
 
-with FuturesSession() as session:
-    futures = [session.get(tag_url_prefix+structure_df.iloc[_]['tag']+'/content/full') for _ in range(20950)]
-    for future in as_completed(futures):
-        response = future.result()
+def fetch_structures(session, limiter):
+    with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+        return list(pool.map(lambda prt: request_with_retry(session, 'GET', tag_url_prefix+prt+tag_structure_suffix,
+                                                            limiter=limiter).json(), parts))
+
+
+def load_completed_tags(content_path=CONTENT_JSONL):
+    # returns dict tag -> byte offset of its line in content_path; a truncated last line is dropped
+    return load_jsonl_index(content_path, 'tag')
+
+
+def download_contents(tags, session, limiter, content_path=CONTENT_JSONL, workers=WORKERS, refresh=False):
+    # fetches /content/full of all tags not yet in content_path (of all tags with refresh=True, sending
+    # conditional requests) and appends changed contents as they complete; later lines replace earlier ones
+    completed = load_completed_tags(content_path)
+    todo = list(dict.fromkeys(tags)) if refresh else [tag for tag in dict.fromkeys(tags) if tag not in completed]
+    print(f"{len(completed)} tags already downloaded, {len(todo)} to {'check' if refresh else 'go'}")
+    store = HttpMetadataStore(HTTP_META_DB)
+
+    def _fetch(tag):
+        if tag in completed:
+            response = conditional_get(session, tag_url_prefix+tag+tags_content_suffix, store, limiter=limiter)
+            if response is None:
+                return None
+        else:
+            response = request_with_retry(session, 'GET', tag_url_prefix+tag+tags_content_suffix, limiter=limiter)
+            store.update(tag_url_prefix+tag+tags_content_suffix, response)
+        return {'tag': tag, 'content': response.content.decode('utf-8', 'surrogateescape')}
+
+    failed, changed = download_jsonl(todo, _fetch, content_path, workers, CHUNK_SIZE)
+    store.close()
+    print(f"{changed} tags downloaded")
+    return failed
+
+
+def iter_rows(structure_df, content_path=CONTENT_JSONL):
+    # yields the structure rows with their content in structure order, reading one content line at a time.
+    # content is the repr of the response bytes (b'...'), the format evaluate_stacks_project expects.
+    offsets = load_completed_tags(content_path)
+    with open(content_path, 'rb') as content_fh:
+        for row in structure_df.itertuples(index=False):
+            content_fh.seek(offsets[row.tag])
+            content = json.loads(content_fh.readline())['content']
+            yield row._asdict(), str(content.encode('utf-8', 'surrogateescape'))
+
+
+def write_csv(structure_df, content_path=CONTENT_JSONL, output_path=OUTPUT_CSV):
+    columns = list(structure_df.columns) + ['content']
+    with open(output_path, 'w', newline='', encoding='utf-8') as out_fh:
+        writer = csv.writer(out_fh)
+        writer.writerow(columns)
+        for row, content in iter_rows(structure_df, content_path):
+            writer.writerow(list(row.values()) + [content])
+
+
+def write_parquet(structure_df, content_path=CONTENT_JSONL, output_path=OUTPUT_PARQUET):
+    # written in row groups of CHUNK_SIZE rows, so only one chunk of contents is held in memory
+    with pq.ParquetWriter(output_path, STACKS_SCHEMA) as writer:
+        chunk = []
+        for row, content in iter_rows(structure_df, content_path):
+            chunk.append(dict(row, content=content))
+            if len(chunk) == CHUNK_SIZE:
+                writer.write_table(pa.Table.from_pylist(chunk, schema=STACKS_SCHEMA))
+                chunk = []
+        if chunk:
+            writer.write_table(pa.Table.from_pylist(chunk, schema=STACKS_SCHEMA))
+
+
+def main(refresh=False):
+    session = make_session(WORKERS)
+    limiter = RateLimiter(RATE)
+    structures = fetch_structures(session, limiter)
+    structure_list = tree_to_list(structures)
+    structure_df = pd.DataFrame(structure_list)
+
+    failed = download_contents(structure_df['tag'].to_list(), session, limiter, refresh=refresh)
+    if failed:
+        print(f"{len(failed)} tags failed, run again to resume: {failed}")
+        return
+    write_csv(structure_df)
+    write_parquet(structure_df)
 
-d = {'content':[future.result().content for future in futures]}
-content_df = pd.DataFrame(d)
-structure_df['content'] = content_df
 
-structure_df.to_csv(os.path.join(HOME,'stacks_project.csv',index=False)
+if __name__ == "__main__":
+    main(refresh="--refresh" in sys.argv[1:])
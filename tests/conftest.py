@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the scripts are run from their own directories; make them importable as top-level modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'LLMExperiments')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from http_utils import RateLimiter, make_session
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        key = server.key(url.path, urllib.parse.parse_qs(url.query))
+        with server.lock:
+            server.requested.append(key)
+        if key in server.broken:
+            self.send_error(400)
+            return
+        if key not in server.documents:
+            self.send_error(404)
+            return
+        content_type, body = server.render(key, server.documents[key])
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def http_server(endpoint):
+    # local stand-in for the remote API given by the `endpoint` fixture of the test module, a pair of
+    # functions: key(path, query) names the requested resource and render(key, document) returns the
+    # (content type, body) of the response. Serves `documents` (key -> document), answers 404 for unknown
+    # keys and 400 for keys in `broken`, and records the requested keys in `requested`. The base url is in `url`.
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.key, server.render = endpoint
+    server.documents, server.broken, server.requested = {}, set(), []
+    server.lock = threading.Lock()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def http_client():
+    # (session, limiter) for the download functions, without rate limiting
+    return make_session(2), RateLimiter(None)
+
+
+@pytest.fixture
+def interrupted_write():
+    def _cut(path, key):
+        # leaves half of the last line of the JSONL file behind, as an interrupted write does; returns the
+        # key field of the record that was cut
+        with open(path, 'rb') as fh:
+            lines = fh.readlines()
+        with open(path, 'wb') as fh:
+            fh.writelines(lines[:-1] + [lines[-1][:len(lines[-1]) // 2]])
+        return json.loads(lines[-1])[key]
+    return _cut
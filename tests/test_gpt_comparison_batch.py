@@ -0,0 +1,153 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import gpt_comparison
+from dataset_io import read_dataset
+
+
+class FakeBatchClient:
+    # in-process stand-in for the files and batches endpoints used by main_batch; results(requests)
+    # returns the (output lines, error lines) of the job from the submitted request lines
+    def __init__(self, results, polls=1):
+        self.results = results
+        self.polls = polls
+        self.submitted = []
+        self.contents = {}
+        self.files = SimpleNamespace(create=self._create_file, content=self._content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve)
+
+    def _create_file(self, file, purpose):
+        self.contents['input'] = file.read().decode('utf-8')
+        return SimpleNamespace(id='input')
+
+    def _content(self, file_id):
+        return SimpleNamespace(text=self.contents[file_id])
+
+    def _create_batch(self, input_file_id, endpoint, completion_window):
+        requests = [json.loads(line) for line in self.contents[input_file_id].splitlines()]
+        self.submitted.append(requests)
+        output, errors = self.results(requests)
+        self.contents['output'] = "\n".join(json.dumps(line) for line in output) + "\n"
+        self.contents['errors'] = "\n".join(json.dumps(line) for line in errors) + "\n"
+        return SimpleNamespace(id='batch_1')
+
+    def _retrieve(self, batch_id):
+        self.polls -= 1
+        status = 'in_progress' if self.polls >= 0 else 'completed'
+        return SimpleNamespace(id=batch_id, status=status, output_file_id='output',
+                               error_file_id='errors' if self.contents.get('errors', '').strip() else None)
+
+
+def success(request, text):
+    body = {'output': [{'type': 'message', 'content': [{'type': 'output_text', 'text': text}]}]}
+    return {'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': body}}
+
+
+def failure(request):
+    return {'custom_id': request['custom_id'], 'response': None,
+            'error': {'code': 'server_error', 'message': 'boom'}}
+
+
+def judgment(request):
+    # the judgment names the formal proof it was asked about, so that misassigned rows are visible
+    prompt = request['body']['input'][1]['content']
+    return json.dumps({'Alignment Score': '5', 'brief_justification': prompt.split('\n')[3]})
+
+
+@pytest.fixture
+def experiment(tmp_path, monkeypatch):
+    rows = [('a1', 'b1'), ('a2', 'b2'), ('', ''), ('a4', 'b4')]
+    with open(tmp_path / 'input.csv', 'w', encoding='utf-8') as fh:
+        fh.write("formal_proof,augmented_proof\n" + "".join(f"{a},{b}\n" for a, b in rows))
+    output = str(tmp_path / 'output.csv')
+    for name, value in [('INPUT_CSV', str(tmp_path / 'input.csv')), ('OUTPUT_CSV', output),
+                        ('CHECKPOINT_JSONL', output + '.checkpoint.jsonl'), ('CACHE_DB', str(tmp_path / 'cache.sqlite')),
+                        ('BATCH_INPUT_JSONL', output + '.batch_input.jsonl'),
+                        ('BATCH_STATE_JSON', output + '.batch.json'), ('BATCH_POLL_SEC', 0),
+                        ('REPLAY_ONLY', False), ('cache_con', None)]:
+        monkeypatch.setattr(gpt_comparison, name, value)
+    return tmp_path
+
+
+def judgments():
+    return [json.loads(comparison) for comparison in read_dataset(gpt_comparison.OUTPUT_CSV)['comparison_json']]
+
+
+def interrupt(seconds):
+    raise KeyboardInterrupt
+
+
+def use_client(monkeypatch, client):
+    monkeypatch.setattr(gpt_comparison, 'client', client)
+    return client
+
+
+def test_results_are_merged_by_custom_id(experiment, monkeypatch):
+    # output lines arrive out of order and failed requests only appear in the error file
+    client = use_client(monkeypatch, FakeBatchClient(
+        lambda requests: ([success(request, judgment(request)) for request in reversed(requests[::2])],
+                          [failure(request) for request in requests[1::2]])))
+    gpt_comparison.main_batch()
+
+    assert [request['custom_id'] for request in client.submitted[0]] == ['row-1', 'row-2', 'row-4']
+    results = judgments()
+    assert results[0]['brief_justification'] == 'a1'
+    assert 'server_error' in results[1]['error']
+    assert results[2]['brief_justification'] == 'No content provided.'
+    assert results[3]['brief_justification'] == 'a4'
+    assert not (experiment / 'output.csv.batch.json').exists()
+
+
+def test_failed_rows_are_resubmitted(experiment, monkeypatch):
+    use_client(monkeypatch, FakeBatchClient(
+        lambda requests: ([success(request, judgment(request)) for request in requests[:-1]],
+                          [failure(requests[-1])])))
+    gpt_comparison.main_batch()
+    assert 'error' in judgments()[3]
+
+    monkeypatch.setattr(gpt_comparison, 'cache_con', None)
+    client = use_client(monkeypatch, FakeBatchClient(
+        lambda requests: ([success(request, judgment(request)) for request in requests], [])))
+    gpt_comparison.main_batch()
+    assert [request['custom_id'] for request in client.submitted[0]] == ['row-4']
+    assert [result['brief_justification'] for result in judgments()] == ['a1', 'a2', 'No content provided.', 'a4']
+
+
+def test_interrupted_run_resumes_polling(experiment, monkeypatch):
+    client = use_client(monkeypatch, FakeBatchClient(
+        lambda requests: ([success(request, judgment(request)) for request in requests], []), polls=5))
+    monkeypatch.setattr(gpt_comparison.time, 'sleep', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        gpt_comparison.main_batch()
+    state = json.loads((experiment / 'output.csv.batch.json').read_text(encoding='utf-8'))
+    assert state['batch_id'] == 'batch_1'
+
+    monkeypatch.setattr(gpt_comparison.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(gpt_comparison, 'cache_con', None)
+    gpt_comparison.main_batch()
+    assert len(client.submitted) == 1
+    assert [result['brief_justification'] for result in judgments()] == ['a1', 'a2', 'No content provided.', 'a4']
+    assert not (experiment / 'output.csv.batch.json').exists()
+
+
+def test_resumed_job_for_other_prompts_only_fills_the_cache(experiment, monkeypatch):
+    client = use_client(monkeypatch, FakeBatchClient(
+        lambda requests: ([success(request, judgment(request)) for request in requests], []), polls=5))
+    monkeypatch.setattr(gpt_comparison.time, 'sleep', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        gpt_comparison.main_batch()
+
+    # the experiment is switched while the job is running: its results must not be taken for the new prompt
+    monkeypatch.setattr(gpt_comparison.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(gpt_comparison, 'cache_con', None)
+    monkeypatch.setattr(gpt_comparison, 'SYSTEM_PROMPT', 'another experiment')
+    gpt_comparison.main_batch()
+    assert len(client.submitted) == 1
+    assert all('error' in result for i, result in enumerate(judgments()) if i != 2)
+
+    client.polls = 0
+    gpt_comparison.main_batch()
+    assert len(client.submitted) == 2
+    assert [result['brief_justification'] for result in judgments()] == ['a1', 'a2', 'No content provided.', 'a4']
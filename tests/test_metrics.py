@@ -0,0 +1,44 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import mathlib_refs
+from metrics import paired_bootstrap, per_query_metrics, summarize
+
+
+def no_results(df, column, new_col_name, num_results=10):
+    df[new_col_name] = [[] for _ in range(len(df))]
+    return df
+
+
+@pytest.mark.parametrize('n_queries', [0, 3])
+def test_metrics_without_results(n_queries):
+    per_query = per_query_metrics(np.zeros((n_queries, 0), dtype=np.int8), [1] * n_queries)
+    assert all(len(values) == n_queries and not values.any() for values in per_query.values())
+
+
+def test_summary_without_queries():
+    per_query = per_query_metrics(np.zeros((0, 0), dtype=np.int8), [])
+    summary = summarize(per_query, n_resamples=10)
+    assert set(summary) == set(per_query)
+    assert all(np.isnan(value) for stats in summary.values() for value in stats.values())
+    comparison = paired_bootstrap(per_query, per_query, n_resamples=10)
+    assert all(np.isnan(value) for stats in comparison.values() for value in stats.values())
+
+
+@pytest.mark.parametrize('texts', [['no match', 'none either'], []])
+def test_evaluation_without_results(texts, tmp_path, monkeypatch):
+    monkeypatch.setattr(mathlib_refs, 'no_results', no_results, raising=False)
+    monkeypatch.setattr(mathlib_refs, 'REPORT_DIR', str(tmp_path))
+    df = pd.DataFrame({'texts': texts, 'module_name': [[['Mathlib', 'A']]] * len(texts),
+                       'code': [['theorem a : True']] * len(texts),
+                       'formal_statement': [['theorem a : True']] * len(texts)})
+    df = mathlib_refs.df_evaluate(df, 'texts', avail_columns=['module_name', 'code'], retriever='no_results',
+                                  use_cache=False, report_name='empty')
+    assert (df['module_match_R@1'] == 0).all()
+    with open(tmp_path / 'empty_no_results.json', encoding='utf-8') as fh:
+        report = json.load(fh)
+    assert report['n_queries'] == len(texts)
+    assert report['metrics']['module_match']['MRR']['mean'] == (0.0 if texts else pytest.approx(np.nan, nan_ok=True))
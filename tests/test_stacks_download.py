@@ -0,0 +1,80 @@
+import json
+
+import pandas as pd
+import pytest
+
+import stacks
+
+TAGS = ['0001', '0002', '0003', '0004']
+
+
+@pytest.fixture
+def endpoint():
+    # /data/tag/<tag>/content/full answers the html page of the tag
+    return (lambda path, query: path.split('/')[3]), (lambda tag, page: ('text/html', page))
+
+
+@pytest.fixture
+def server(http_server, tmp_path, monkeypatch):
+    http_server.documents.update({tag: f'<p>Lemma {tag}. Statement {tag}.</p><p>Proof. See {tag}.</p>'
+                                  for tag in TAGS})
+    monkeypatch.setattr(stacks, 'tag_url_prefix', http_server.url + '/data/tag/')
+    monkeypatch.setattr(stacks, 'HTTP_META_DB', str(tmp_path / 'meta.sqlite'))
+    return http_server
+
+
+@pytest.fixture
+def download(http_client, tmp_path):
+    content_path = str(tmp_path / 'content.jsonl')
+
+    def _download(tags):
+        return stacks.download_contents(tags, *http_client, content_path=content_path, workers=2)
+    _download.path = content_path
+    return _download
+
+
+def contents(content_path):
+    with open(content_path, encoding='utf-8') as fh:
+        return {record['tag']: record['content'] for record in map(json.loads, fh)}
+
+
+def test_download_resumes_with_missing_tags(server, download):
+    assert download(TAGS[:2]) == []
+    server.requested.clear()
+
+    assert download(TAGS) == []
+    assert sorted(server.requested) == TAGS[2:]
+    assert contents(download.path) == server.documents
+
+
+def test_truncated_last_line_is_repaired(server, download, interrupted_write):
+    download(TAGS)
+    last_tag = interrupted_write(download.path, 'tag')
+
+    assert set(stacks.load_completed_tags(download.path)) == set(TAGS) - {last_tag}
+    server.requested.clear()
+    download(TAGS)
+    assert server.requested == [last_tag]
+    assert contents(download.path) == server.documents
+
+
+def test_failed_tags_are_reported_and_retried(server, download):
+    server.broken = {'0003'}
+    assert download(TAGS) == ['0003']
+    assert set(contents(download.path)) == {'0001', '0002', '0004'}
+
+    server.broken = set()
+    server.requested.clear()
+    assert download(TAGS) == []
+    assert server.requested == ['0003']
+    assert contents(download.path) == server.documents
+
+
+def test_rows_keep_structure_order(server, download, tmp_path):
+    download(TAGS)
+    structure_df = pd.DataFrame([{'tag': tag, 'name': 'N/A', 'reference': tag, 'type': 'lemma', 'depth': 0,
+                                  'parents': []} for tag in reversed(TAGS)])
+    stacks.write_csv(structure_df, download.path, str(tmp_path / 'stacks_project.csv'))
+    written = pd.read_csv(tmp_path / 'stacks_project.csv', dtype=str)
+    assert written['tag'].to_list() == list(reversed(TAGS))
+    assert written['content'].to_list() == [str(server.documents[tag].encode('utf-8')) for tag in reversed(TAGS)]
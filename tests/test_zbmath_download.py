@@ -0,0 +1,90 @@
+import json
+
+import pandas as pd
+import pytest
+
+import zbmath
+
+IDS = ['0012.30702', '1234.56789', '9999.99999', '0500.10000']
+
+
+def search_result(zbl_id, review):
+    contributions = [{'text': review}] if review else []
+    return 'application/json', json.dumps({'result': [{'editorial_contributions': contributions}]})
+
+
+@pytest.fixture
+def endpoint():
+    # /v1/document/_search?search_string=an:<id> answers the document of the id with its review (none if empty)
+    return (lambda path, query: query['search_string'][0][len('an:'):]), search_result
+
+
+@pytest.fixture
+def server(http_server, monkeypatch):
+    http_server.documents.update({'0012.30702': 'Review of 0012.30702.', '1234.56789': 'Review of 1234.56789.',
+                                  '0500.10000': ''})
+    monkeypatch.setattr(zbmath, 'ZBMATH_API_URL', http_server.url + '/v1/document/_search')
+    return http_server
+
+
+@pytest.fixture
+def download(http_client, tmp_path):
+    abstracts_path = str(tmp_path / 'abstracts.jsonl')
+
+    def _download(zbl_ids, **kwargs):
+        return zbmath.download_abstracts(zbl_ids, *http_client, abstracts_path=abstracts_path, workers=2, **kwargs)
+    _download.path = abstracts_path
+    return _download
+
+
+@pytest.mark.parametrize('zbl_id, canonical', [
+    ('12.30702', '0012.30702'),  # read from lean_zbl_ids.csv as a float
+    ('Zbl 0012.30702', '0012.30702'),
+    ('zbl1234.56789', '1234.56789'),
+    ('1234.5678', '1234.56780'),
+    (' 1234.56789 ', '1234.56789'),
+    ('JFM 12.0345.01', 'JFM 12.0345.01'),
+    ('0012', '0012'),
+])
+def test_canonical_zbl_id(zbl_id, canonical):
+    assert zbmath.canonical_zbl_id(zbl_id) == canonical
+
+
+def test_ids_are_queried_in_canonical_form(server, download):
+    assert download(['12.30702', 'Zbl 1234.56789']) == []
+    assert sorted(server.requested) == ['0012.30702', '1234.56789']
+    # ids keep the form they were given in, so that they join with the references they came from
+    assert zbmath.load_completed_ids(download.path) == {'12.30702': 'Review of 0012.30702.',
+                                                        'Zbl 1234.56789': 'Review of 1234.56789.'}
+
+
+def test_missing_documents_have_no_abstract(server, download, tmp_path):
+    assert download(IDS[:1] + IDS[2:]) == []
+    assert zbmath.load_completed_ids(download.path) == {'0012.30702': 'Review of 0012.30702.',
+                                                        '9999.99999': None, '0500.10000': None}
+
+    output_path = str(tmp_path / 'leandocs.csv')
+    zbmath.write_leandocs(IDS, download.path, output_path)
+    assert pd.read_csv(output_path, dtype=str).to_dict('records') == [
+        {'zbl_id': '0012.30702', 'texts': 'Review of 0012.30702.'}]
+
+
+def test_download_resumes(server, download, interrupted_write):
+    server.broken = {'1234.56789'}
+    assert download(IDS) == ['1234.56789']
+    cut_id = interrupted_write(download.path, 'zbl_id')
+
+    server.broken = set()
+    server.requested.clear()
+    assert download(IDS) == []
+    assert sorted(server.requested) == sorted(['1234.56789', cut_id])
+    assert set(zbmath.load_completed_ids(download.path)) == set(IDS)
+
+    # ids without abstract are only queried again on request
+    server.documents['9999.99999'] = 'Review of 9999.99999.'
+    server.requested.clear()
+    download(IDS)
+    assert server.requested == []
+    download(IDS, retry_missing=True)
+    assert sorted(server.requested) == ['0500.10000', '9999.99999']
+    assert zbmath.load_completed_ids(download.path)['9999.99999'] == 'Review of 9999.99999.'
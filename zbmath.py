@@ -0,0 +1,124 @@
+import argparse
+import os
+import pandas as pd
+import requests
+from dataset_io import write_dataset
+from http_utils import RateLimiter, download_jsonl, load_jsonl_index, make_session, request_with_retry
+
+# Builds leandocs.csv (zbl_id, texts) from api.zbmath.org for the ZBL_IDs in lean_zbl_ids.csv and the ones
+# cited in mathlib4 (match_bibrefs_to_bib_file). Abstracts are appended to ABSTRACTS_JSONL as they arrive
+# ({"zbl_id":..., "texts":...} per line, texts null if zbMATH has no document or review for the id), so a
+# restarted run only fetches the missing ids; leandocs.csv is written from it once all ids are done.
+
+# change if needed.
+HOME = os.getcwd()
+ZBMATH_API_URL = os.environ.get('ZBMATH_API_URL', 'https://api.zbmath.org/v1/document/_search')
+LEAN_ZBL_IDS_CSV = os.path.join(HOME,'lean_zbl_ids.csv')
+ABSTRACTS_JSONL = os.path.join(HOME,'zbmath_abstracts.jsonl')
+OUTPUT_CSV = os.path.join(HOME,'leandocs.csv')
+WORKERS = 4  # requests in flight
+RATE = 5  # requests per second
+
+
+def canonical_zbl_id(zbl_id):
+    # '12.30702' (as left by reading lean_zbl_ids.csv as floats) or 'Zbl 0012.30702' -> '0012.30702'
+    zbl_id = str(zbl_id).strip()
+    if zbl_id.lower().startswith('zbl'):
+        zbl_id = zbl_id[3:].strip()
+    if '.' not in zbl_id:
+        return zbl_id
+    volume, number = zbl_id.split('.', 1)
+    if volume.isdigit() and number.isdigit():
+        return f"{int(volume):04d}.{number.ljust(5, '0')}"
+    return zbl_id
+
+
+def collect_zbl_ids(ids_csv=LEAN_ZBL_IDS_CSV, include_mathlib=True):
+    # returns dict canonical id -> id as written to leandocs.csv; ids cited in mathlib keep the form of the
+    # bib file, so that they join with the references in mathlib_refs
+    zbl_ids = {}
+    if include_mathlib:
+        from mathlib_refs import match_bibrefs_to_bib_file
+        for ids in match_bibrefs_to_bib_file(books_ok=True).values():
+            for zbl_id in ids:
+                zbl_ids.setdefault(canonical_zbl_id(zbl_id), zbl_id)
+    if ids_csv and os.path.exists(ids_csv):
+        for zbl_id in pd.read_csv(ids_csv, dtype=str)['zbl_id'].dropna():
+            zbl_ids.setdefault(canonical_zbl_id(zbl_id), canonical_zbl_id(zbl_id))
+    return zbl_ids
+
+
+def load_completed_ids(abstracts_path=ABSTRACTS_JSONL):
+    # returns dict zbl_id -> texts (None if not found) of the finished ids; a truncated last line is dropped
+    return load_jsonl_index(abstracts_path, 'zbl_id', 'texts')
+
+
+def document_text(document):
+    # reviews and summaries of a zbMATH document, joined
+    texts = [contribution.get('text') or '' for contribution in document.get('editorial_contributions') or []]
+    return "\n".join(text.strip() for text in texts if text.strip()) or None
+
+
+def fetch_abstract(zbl_id, session, limiter):
+    try:
+        response = request_with_retry(session, 'GET', ZBMATH_API_URL, limiter=limiter,
+                                      params={'search_string': f'an:{canonical_zbl_id(zbl_id)}',
+                                              'page': 0, 'results_per_page': 1})
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise
+    documents = response.json().get('result') or []
+    return document_text(documents[0]) if documents else None
+
+
+def download_abstracts(zbl_ids, session, limiter, abstracts_path=ABSTRACTS_JSONL, workers=WORKERS,
+                       retry_missing=False):
+    # fetches the abstracts of all ids not yet in abstracts_path (and of the ones without abstract with
+    # retry_missing=True) and appends them as they complete; later lines replace earlier ones
+    completed = load_completed_ids(abstracts_path)
+    todo = [zbl_id for zbl_id in dict.fromkeys(zbl_ids)
+            if zbl_id not in completed or (retry_missing and completed[zbl_id] is None)]
+    print(f"{len(completed)} ids already fetched, {len(todo)} to go")
+
+    found = []
+
+    def _fetch(zbl_id):
+        texts = fetch_abstract(zbl_id, session, limiter)
+        if texts is not None:
+            found.append(zbl_id)
+        return {'zbl_id': zbl_id, 'texts': texts}
+
+    failed, _ = download_jsonl(todo, _fetch, abstracts_path, workers)
+    print(f"{len(found)} abstracts found")
+    return failed
+
+
+def write_leandocs(zbl_ids, abstracts_path=ABSTRACTS_JSONL, output_path=OUTPUT_CSV):
+    # one row per id with an abstract, in the order of zbl_ids
+    completed = load_completed_ids(abstracts_path)
+    rows = [{'zbl_id': zbl_id, 'texts': completed[zbl_id]} for zbl_id in dict.fromkeys(zbl_ids)
+            if completed.get(zbl_id) is not None]
+    write_dataset(pd.DataFrame(rows, columns=['zbl_id', 'texts']), output_path)
+    print(f"{len(rows)} abstracts written to {output_path}")
+
+
+def main(include_mathlib=True, retry_missing=False):
+    zbl_ids = list(collect_zbl_ids(include_mathlib=include_mathlib).values())
+    session = make_session(WORKERS, {'accept': 'application/json'})
+    limiter = RateLimiter(RATE)
+    failed = download_abstracts(zbl_ids, session, limiter, retry_missing=retry_missing)
+    if failed:
+        print(f"{len(failed)} ids failed, run again to resume: {failed}")
+        return
+    write_leandocs(zbl_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build leandocs.csv from api.zbmath.org")
+    parser.add_argument("--no-mathlib", action="store_true",
+                        help="only fetch the ids in lean_zbl_ids.csv, without scanning mathlib4 for cited ones")
+    parser.add_argument("--retry-missing", action="store_true",
+                        help="query the ids again for which zbMATH returned no abstract before")
+    args = parser.parse_args()
+    main(include_mathlib=not args.no_mathlib, retry_missing=args.retry_missing)